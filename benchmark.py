@@ -0,0 +1,452 @@
+import gc
+import os
+import sys
+import json
+import time
+import tracemalloc
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import queue
+import subprocess
+import multiprocessing
+from types import SimpleNamespace
+from contextlib import contextmanager
+import catalyst
+from catalyst import (
+    Book, ColumnarBooks, JsonBookStorage, JournalBookStorage, SqliteBookStorage, SharedJournalBookStorage,
+    Library,
+    UserStore, SqliteUserStore, save_users, use_user_store, find_user_record_by_username,
+    write_binary_snapshot, file_stamp,
+)
+
+WORDS = (
+    "the of and a war world night house time lost last dark river city king queen "
+    "secret garden shadow island star winter summer dragon stone fire sea road "
+    "empire silent glass iron heart moon storm forest letter memory crown ghost "
+    "machine journey return song blood golden hidden broken long invisible"
+).split()
+FIRST = "Mary Arthur Jane Lewis Bram Jules Herbert George Agatha Ursula Isaac Terry Octavia Frank Virginia".split()
+LAST = "Shelley Doyle Austen Carroll Stoker Verne Wells Orwell Christie Le_Guin Asimov Pratchett Butler Herbert Woolf".split()
+# -----------------------------
+# Synthetic catalogs
+# -----------------------------
+def make_authors(count, rng):
+    return [f"{rng.choice(FIRST)} {rng.choice(LAST).replace('_', ' ')} {i}" for i in range(count)]
+def make_catalog(size, seed=7):
+    # Author popularity follows a Zipf-like skew: a few authors own most books
+    rng = random.Random(seed)
+    authors = make_authors(max(10, size // 20), rng)
+    weights = [1.0 / (rank + 1) for rank in range(len(authors))]
+    picks = rng.choices(authors, weights=weights, k=size)
+    books = []
+    for i in range(size):
+        title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 6))).capitalize()
+        books.append({"title": f"{title} {i}", "author": picks[i], "available": True, "borrowed_by": None})
+    return books
+class MemoryStorage:
+    def __init__(self, records):
+        self.records = records
+    def load(self):
+        return list(self.records)
+    def save(self, books):
+        pass
+    def commit(self, books, changed):
+        pass
+    def close(self):
+        pass
+def make_library(size):
+    library = Library(MemoryStorage(make_catalog(size)))
+    library.load_books()
+    return library
+def timeit(fn, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+def record(results, suite, case, size, value):
+    # Flat "suite/case/size" keys; every value is lower-is-better
+    results[f"{suite}/{case}/{size}"] = value
+# -----------------------------
+# Benchmarks
+# -----------------------------
+def linear_filter(books, keyword):
+    # The pre-index implementation of Library.filter_books
+    keyword = keyword.lower()
+    return [book for book in books if keyword in book.title.lower() or keyword in book.author.lower()]
+def bench_search(sizes, results):
+    queries = ["the", "dragon", "golden crown", "war of the", "shelley", "st", "zzz", "1234"]
+    for size in sizes:
+        start = time.perf_counter()
+        library = make_library(size)
+        build = time.perf_counter() - start
+        print(f"\n{size:,} books (load + index {build:.2f}s)")
+        print(f"  {'query':<14}{'hits':>9}{'linear ms':>12}{'index ms':>11}{'speedup':>9}")
+        for query in queries:
+            expected = linear_filter(library.books, query)
+            got = library.filter_books(query)
+            if {b.book_id for b in got} != {b.book_id for b in expected}:
+                sys.exit(f"mismatch for {query!r}")
+            linear = timeit(lambda: linear_filter(library.books, query), repeat=3)
+            indexed = timeit(lambda: library.filter_books(query), repeat=3)
+            print(f"  {query!r:<14}{len(got):>9}{linear * 1000:>12.2f}{indexed * 1000:>11.2f}{linear / indexed:>8.1f}x")
+            record(results, "search", f"filter_books[{query}]", size, indexed)
+class LegacyBook:
+    # Book as it was before __slots__ and author interning
+    def __init__(self, title, author, available=True, borrowed_by=None):
+        self.title = title
+        self.author = author
+        self.available = available
+        self.borrowed_by = borrowed_by
+def build_legacy(records):
+    return [LegacyBook(**record) for record in records]
+def build_slots(records):
+    return [Book(**record) for record in records]
+def build_columnar(records):
+    books = ColumnarBooks()
+    for record in records:
+        books.append(Book(**record))
+    return books
+def bench_memory(sizes, results):
+    builders = [("dict Book", build_legacy), ("slots Book", build_slots), ("columnar", build_columnar)]
+    for size in sizes:
+        # Decode from JSON like load_books does, so every author string is
+        # its own object until something interns it
+        blob = json.dumps(make_catalog(size))
+        print(f"\n{size:,} books")
+        print(f"  {'layout':<12}{'MiB':>9}{'bytes/book':>12}")
+        for name, build in builders:
+            gc.collect()
+            tracemalloc.start()
+            records = json.loads(blob)
+            books = build(records)
+            del records
+            gc.collect()
+            used = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print(f"  {name:<12}{used / 2**20:>9.1f}{used / size:>12.0f}")
+            record(results, "memory", f"{name.replace(' ', '_')}_bytes_per_book", size, used / size)
+            del books
+def bench_startup(sizes, results):
+    # Cold start = load_books plus what the first screen needs (one page of
+    # rows), versus building every index for the first search
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "books.json")
+        for size in sizes:
+            records = make_catalog(size)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(records, f, indent=4)
+            write_binary_snapshot(os.path.join(tmp, "books.bin"), records, file_stamp(path))
+            print(f"\n{size:,} books")
+            print(f"  {'source':<10}{'load s':>9}{'first page s':>14}{'first search s':>16}")
+            for name, binary in (("json", False), ("binary", True)):
+                library = Library(JsonBookStorage(path, binary_snapshot=binary))
+                start = time.perf_counter()
+                library.load_books()
+                loaded = time.perf_counter() - start
+                page = [(b.title, b.author, b.available) for b in library.books[:50]]
+                paged = time.perf_counter() - start
+                library.filter_books("dragon")
+                searched = time.perf_counter() - start
+                print(f"  {name:<10}{loaded:>9.3f}{paged:>14.3f}{searched:>16.3f}")
+                record(results, "startup", f"{name}_first_page", size, paged)
+                record(results, "startup", f"{name}_first_search", size, searched)
+                del library, page
+def per_op(fn, items):
+    start = time.perf_counter()
+    for item in items:
+        fn(item)
+    return (time.perf_counter() - start) / max(1, len(items))
+def best_per_op(fn, items, repeat=3):
+    return min(per_op(fn, items) for _ in range(repeat))
+def bench_library(sizes, results):
+    # Library operations on the in-memory catalog, then what each storage
+    # backend adds to a single checkout (json rewrites the whole file)
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            records = make_catalog(size)
+            path = os.path.join(tmp, "books.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(records, f, indent=4)
+            repeat = 3 if size <= 100_000 else 1
+            print(f"\n{size:,} books")
+            library = Library(JsonBookStorage(path))
+            load = timeit(library.load_books, repeat)
+            save = timeit(library.save_books, repeat)
+            print(f"  load_books {load:.3f}s   save_books {save:.3f}s")
+            record(results, "library", "load_books", size, load)
+            record(results, "library", "save_books", size, save)
+            library = make_library(size)
+            rng = random.Random(size)
+            titles = [library.books[i].title for i in rng.sample(range(size), min(size, 10_000))]
+            ops = {
+                "add_book": best_per_op(lambda i: library.add_book(Book(f"New {i}", "Bench Author")), range(10_000)),
+                "checkout_book": float("inf"),
+                "return_book": float("inf"),
+                "filter_books": best_per_op(library.filter_books, ["dragon", "the", "golden crown", "shelley", "zzz"]),
+            }
+            for _ in range(3):
+                # Each pass lends every sampled title and takes it back
+                ops["checkout_book"] = min(ops["checkout_book"], per_op(lambda t: library.checkout_book(t, "bench"), titles))
+                ops["return_book"] = min(ops["return_book"], per_op(lambda t: library.return_book(t, "bench"), titles))
+            for name, seconds in ops.items():
+                print(f"  {name:<14}{seconds * 1e6:>12.1f} us/op")
+                record(results, "library", name, size, seconds)
+            for backend in ("json", "journal", "sqlite"):
+                storage = {
+                    "json": lambda: JsonBookStorage(path),
+                    "journal": lambda: JournalBookStorage(path, os.path.join(tmp, f"books-{size}.journal")),
+                    "sqlite": lambda: SqliteBookStorage(os.path.join(tmp, f"books-{size}.db")),
+                }[backend]()
+                library = Library(storage)
+                if backend == "sqlite":
+                    storage.save([Book(**r) for r in records])
+                library.load_books()
+                count = 3 if backend == "json" else 500
+                seconds = per_op(lambda title: library.checkout_book(title, "bench"), titles[:count])
+                storage.close()
+                print(f"  {backend + ' checkout':<14}{seconds * 1e3:>12.3f} ms/op")
+                record(results, "storage", f"{backend}_checkout", size, seconds)
+def bench_users(sizes, results):
+    # find_user_record_by_username against logins.json and catalyst.db
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            users = [{"user_hash": f"user{i}", "pass_hash": "$2b$12$" + "x" * 53} for i in range(size)]
+            save_users(users, os.path.join(tmp, "logins.json"))
+            db = SqliteUserStore(os.path.join(tmp, f"users-{size}.db"))
+            with db._conn:
+                db._conn.executemany("INSERT INTO users VALUES (?, ?)", ((u["user_hash"], u["pass_hash"]) for u in users))
+            rng = random.Random(size)
+            names = [f"user{rng.randrange(size)}" for _ in range(10_000)] + ["nobody"] * 100
+            print(f"\n{size:,} users")
+            for name, store in (("json", UserStore(os.path.join(tmp, "logins.json"))), ("sqlite", db)):
+                use_user_store(store)
+                start = time.perf_counter()
+                find_user_record_by_username("user0")
+                first = time.perf_counter() - start
+                seconds = best_per_op(find_user_record_by_username, names)
+                print(f"  {name:<8} first lookup {first * 1e3:>8.2f} ms   then {seconds * 1e6:>7.1f} us/op")
+                record(results, "users", f"{name}_first_lookup", size, first)
+                record(results, "users", f"{name}_lookup", size, seconds)
+            db._conn.close()
+def shared_storage(directory):
+    # Low journal limits so compactions happen while the other desks write
+    return SharedJournalBookStorage(os.path.join(directory, "books.json"), os.path.join(directory, "books.journal"),
+                                    max_records=300)
+def shared_desk(directory, desk, ops, titles, out):
+    # One process: random checkouts, returns of its own loans, additions and sign-ups
+    library = Library(shared_storage(directory))
+    library.load_books()
+    users = UserStore(os.path.join(directory, "logins.json"), shared=True)
+    rng = random.Random(desk)
+    borrower = f"desk{desk}"
+    held = []
+    stats = {"borrower": borrower, "checkouts": 0, "busy": 0, "returns": 0, "failed_returns": 0, "added": [], "users": []}
+    start = time.perf_counter()
+    for i in range(ops):
+        roll = rng.random()
+        if roll < 0.45 or (roll < 0.9 and not held):
+            title = rng.choice(titles)
+            if library.checkout_book(title, borrower):
+                held.append(title)
+                stats["checkouts"] += 1
+            else:
+                stats["busy"] += 1
+        elif roll < 0.9:
+            # Only fails if another desk overwrote our loan
+            if library.return_book(held.pop(rng.randrange(len(held))), borrower):
+                stats["returns"] += 1
+            else:
+                stats["failed_returns"] += 1
+        elif roll < 0.98:
+            stats["added"].append(f"{borrower} addition {i}")
+            library.add_book(Book(stats["added"][-1], "Stress Test"))
+        else:
+            stats["users"].append(f"{borrower}-user{i}")
+            users.add({"user_hash": stats["users"][-1], "pass_hash": "x"})
+    stats["seconds"] = time.perf_counter() - start
+    stats["held"] = held
+    library.storage.close()
+    out.put(stats)
+def bench_shared(sizes, results, processes=4, ops=500):
+    # Several processes on one data directory (storage "shared"); a fresh
+    # load afterwards must show every desk's loans, additions and sign-ups
+    context = multiprocessing.get_context("spawn")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            records = make_catalog(size)
+            with open(os.path.join(tmp, "books.json"), "w", encoding="utf-8") as f:
+                json.dump(records, f)
+            # A handful of titles so the desks keep competing for the same copies
+            titles = [record["title"] for record in records[:processes * 3]]
+            out = context.Queue()
+            desks = [context.Process(target=shared_desk, args=(tmp, i, ops, titles, out)) for i in range(processes)]
+            start = time.perf_counter()
+            for desk in desks:
+                desk.start()
+            stats = []
+            while len(stats) < processes:
+                try:
+                    stats.append(out.get(timeout=1))
+                except queue.Empty:
+                    if any(desk.exitcode for desk in desks):
+                        sys.exit("shared: a desk process crashed")
+            wall = time.perf_counter() - start
+            for desk in desks:
+                desk.join()
+            library = Library(shared_storage(tmp))
+            library.load_books()
+            store = UserStore(os.path.join(tmp, "logins.json"))
+            problems = []
+            added = [title for desk in stats for title in desk["added"]]
+            if len(library.books) != size + len(added):
+                problems.append(f"{len(library.books)} books, expected {size + len(added)}")
+            lost = [title for title in added if library.title_record(title) is None]
+            if lost:
+                problems.append(f"{len(lost)} additions lost")
+            for desk in stats:
+                on_disk = sorted(book.title for book in library.books if book.borrowed_by == desk["borrower"])
+                if on_disk != sorted(desk["held"]):
+                    problems.append(f"{desk['borrower']} holds {len(desk['held'])} loans, file says {len(on_disk)}")
+                if desk["failed_returns"]:
+                    problems.append(f"{desk['borrower']} could not return {desk['failed_returns']} of its loans")
+            signed_up = [name for desk in stats for name in desk["users"]]
+            missing = [name for name in signed_up if store.find(name) is None]
+            if missing:
+                problems.append(f"{len(missing)} sign-ups lost")
+            library.storage.close()
+            total = processes * ops
+            print(f"\n{size:,} books, {processes} processes x {ops} operations")
+            print(f"  {total / wall:>10,.0f} ops/s together, slowest desk {max(d['seconds'] for d in stats):.2f} s")
+            print(f"  {sum(d['checkouts'] for d in stats)} checkouts ({sum(d['busy'] for d in stats)} found no copy), "
+                  f"{sum(d['returns'] for d in stats)} returns, {len(added)} additions, {len(signed_up)} sign-ups")
+            record(results, "shared", f"{processes}proc_op", size, wall / total)
+            if problems:
+                sys.exit("shared: lost updates: " + "; ".join(problems))
+            print("  no lost updates")
+@contextmanager
+def virtual_display():
+    # The real $DISPLAY if there is one, else a throwaway Xvfb server
+    if os.environ.get("DISPLAY"):
+        yield os.environ["DISPLAY"]
+        return
+    if not shutil.which("Xvfb"):
+        yield None
+        return
+    display = f":{random.randint(100, 999)}"
+    server = subprocess.Popen(["Xvfb", display, "-screen", "0", "1280x1024x24"],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    os.environ["DISPLAY"] = display
+    try:
+        time.sleep(0.5)
+        yield display
+    finally:
+        del os.environ["DISPLAY"]
+        server.terminate()
+        server.wait()
+def drain(view):
+    # Runs Tk until refresh_tree's after() slices are done
+    while view._refresh_job is not None:
+        view.update()
+    view.update_idletasks()
+def bench_ui(sizes, results):
+    # Needs a display: $DISPLAY, or Xvfb on PATH for a throwaway one. Without
+    # either (or if Tk cannot open it) the suite is skipped, so "all" still runs
+    with virtual_display() as display:
+        if display is None:
+            print("ui: skipped, no $DISPLAY and no Xvfb (try xvfb-run python benchmark.py ui)")
+            return
+        import tkinter
+        import customtkinter as ctk
+        try:
+            root = ctk.CTk()
+        except tkinter.TclError as e:
+            print(f"ui: skipped, cannot open display {display} ({e})")
+            return
+        root.geometry("820x600")
+        for size in sizes:
+            library = make_library(size)
+            controller = SimpleNamespace(
+                settings=dict(catalyst.DEFAULT_SETTINGS), library=library, current_user="bench",
+                bg_color="#272B43", fg_color="#1A1A1A", text_color="#F5F5F5",
+                accent_color="#2F00FF", accent_hover="#2F00FF", entry_bg="#111111",
+            )
+            view = catalyst.LibraryView(root, controller)
+            view.pack(fill="both", expand=True)
+            root.update()
+            cases = {}
+            start = time.perf_counter()
+            view.refresh_tree()
+            drain(view)
+            cases["first_render"] = time.perf_counter() - start
+            library.checkout_book(library.books[size // 2].title, "bench")
+            start = time.perf_counter()
+            view.refresh_tree()
+            drain(view)
+            cases["one_row_changed"] = time.perf_counter() - start
+            start = time.perf_counter()
+            view.refresh_tree(library.filter_books("dragon"))
+            drain(view)
+            cases["filtered"] = time.perf_counter() - start
+            print(f"\n{size:,} books ({'virtual' if view._virtual else 'full'} table)")
+            for name, seconds in cases.items():
+                print(f"  {name:<16}{seconds * 1e3:>10.1f} ms")
+                record(results, "ui", name, size, seconds)
+            view.destroy()
+        root.destroy()
+SUITES = {
+    "search": bench_search,
+    "memory": bench_memory,
+    "startup": bench_startup,
+    "library": bench_library,
+    "users": bench_users,
+    "ui": bench_ui,
+    "shared": bench_shared,
+}
+def compare(results, baseline, threshold):
+    # Returns the keys that got more than `threshold` (a fraction) worse
+    regressions = []
+    for key, value in sorted(results.items()):
+        old = baseline.get(key)
+        if not old:
+            continue
+        change = value / old - 1
+        flag = "REGRESSION" if change > threshold else ""
+        if flag:
+            regressions.append(key)
+        print(f"  {key:<48}{old:>12.6g}{value:>12.6g}{change:>+9.1%}  {flag}")
+    return regressions
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Catalyst benchmarks")
+    parser.add_argument("suites", nargs="+", choices=[*SUITES, "all"],
+                        help="ui needs $DISPLAY or Xvfb and is skipped without one")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--json", help="write results (and run details) to this file")
+    parser.add_argument("--baseline", help="results file from an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="fail if a number is this much worse than the baseline (default 0.25 = 25%%)")
+    args = parser.parse_args()
+    results = {}
+    for name in (list(SUITES) if "all" in args.suites else args.suites):
+        SUITES[name](args.sizes, results)
+    if args.json:
+        run = {
+            "version": catalyst.APP_VERSION,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "results": results,
+        }
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(run, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        print(f"\nAgainst {args.baseline} (threshold {args.threshold:.0%})")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            sys.exit(f"{len(regressions)} regression(s): {', '.join(regressions)}")
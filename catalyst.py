@@ -1,62 +1,793 @@
+import time
+# Must stay above the other imports: startup is measured from here to the
+# first frame, and the imports (bcrypt, customtkinter) are part of it
+STARTUP_CLOCK = time.perf_counter()
 import os
+import sys
+import csv
 import json
-import time
+import math
+import heapq
+import queue
+import mmap
+import zlib
+import struct
+import re
+import unicodedata
+import sqlite3
+import atexit
+import argparse
+import cProfile
+import functools
+import threading
+import traceback
+from types import SimpleNamespace
+from collections import deque
+from concurrent.futures import Future
+from array import array
+from contextlib import contextmanager
+if os.name == "nt":
+    import msvcrt
+    fcntl = None
+else:
+    import fcntl
+    msvcrt = None
 import bcrypt
 import requests
 import tkinter as tk
 from tkinter import ttk, messagebox
 import customtkinter as ctk
-import google.generativeai as genai
-from google.generativeai import types as genai_types  # Import types for GenerateContentConfig
+# google.generativeai is imported lazily in App._create_model: it is slow to
+# load and most sessions never open the genre flow
 
 LOG_FILE = "log.txt"
 USERS_FILE = "logins.json"
 BOOKS_FILE = "books.json"
+BOOKS_JOURNAL = "books.journal"
+BOOKS_SNAPSHOT = "books.bin"
+DATABASE_FILE = "catalyst.db"
+SETTINGS_FILE = "settings.json"
+RECOMMENDATIONS_CACHE = "recommendations_cache.json"
+STARTUP_TIMES = "startup_times.jsonl"
+ANALYTICS_STATE = "log_analytics.json"
+PROFILE_DIR = "profiles"
+STALL_REPORT = "stalls.jsonl"
+APP_VERSION = "1.0.0.0"
+DEFAULT_SETTINGS = {
+    # Where books and users live: "json" rewrites books.json on every change,
+    # "journal" appends to books.journal, "sqlite" keeps both in catalyst.db
+    # (imported from the JSON files the first time), "shared" is the journal
+    # plus file locks for several instances on one data directory
+    "storage": "json",
+    "journal_max_records": 5000,
+    "journal_max_bytes": 4 * 1024 * 1024,
+    # Keep books.bin next to books.json and map it at startup instead of
+    # parsing the JSON (rebuilt whenever books.json is newer)
+    "binary_snapshot": False,
+    # Also treat near matches (MinHash over title+author) as duplicates
+    "near_duplicates": False,
+    # Keep the catalog in parallel columns instead of one object per book
+    "compact_catalog": False,
+    # Result sets larger than this are shown in a virtualized table
+    "virtual_table_threshold": 20000,
+    # Loan period for checkouts; the due date is stored with the loan
+    "loan_days": 14,
+    # With "shared" storage, seconds between checks for other instances' changes
+    "sync_interval": 2,
+    # "gemini", or "fake" for a local stand-in that sleeps ai_fake_latency seconds
+    "ai_backend": "gemini",
+    "ai_timeout": 30,
+    "ai_fake_latency": 1.5,
+    "ai_cache_ttl": 7 * 24 * 3600,
+    "ai_cache_entries": 64,
+    # Build the AI client on a background thread once the login screen is up,
+    # instead of on the first genre lookup
+    "ai_warmup": False,
+    # bcrypt cost for new hashes; with bcrypt_target_ms set it is calibrated
+    # at startup instead, and older hashes are upgraded on successful login
+    "bcrypt_rounds": 12,
+    "bcrypt_target_ms": None,
+    # log.txt is rotated to log.txt.1 .. log.txt.N once it reaches this size
+    "log_max_bytes": 5 * 1024 * 1024,
+    "log_backups": 3,
+    # Per-operation counts and p50/p95/p99 latencies, written every
+    # metrics_interval seconds to metrics_file (Prometheus text if it ends
+    # in .prom, JSON otherwise). With profile_slow_ms set, operations at
+    # least that slow also leave a cProfile dump in profiles/
+    "metrics": False,
+    "metrics_file": "metrics.json",
+    "metrics_interval": 10,
+    "profile_slow_ms": None,
+    # Tk main-loop stalls at least this long are logged, with the handler
+    # that was running, to stalls.jsonl (last stall_report_entries kept);
+    # None turns the watchdog off
+    "stall_threshold_ms": 250,
+    "stall_report_entries": 50,
+}
 # -----------------------------
 # Util: logging
 # -----------------------------
+class LogSink:
+    # Lines are timestamped by the caller's thread and queued; a writer thread
+    # appends them in batches, flushing when flush_lines are pending or
+    # flush_interval seconds have passed. flush() blocks until everything
+    # queued before it is on disk (or timeout passes, so a stuck disk cannot
+    # hang shutdown). Queue order is file order.
+    def __init__(self, path=LOG_FILE, max_bytes=DEFAULT_SETTINGS["log_max_bytes"],
+                 backups=DEFAULT_SETTINGS["log_backups"], flush_lines=256, flush_interval=0.5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_lines = flush_lines
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+    def write(self, messages):
+        ts = time.strftime("%Y-%m-%d %H:%M:%S")
+        self._queue.put("".join(f"[{ts}] {message}\n" for message in messages))
+        if self._thread is None:
+            self._start()
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+    def flush(self, timeout=5.0):
+        # False if the writer did not catch up within timeout
+        if self._thread is None or not self._thread.is_alive():
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+    def _run(self):
+        pending = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if isinstance(item, str):
+                pending.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if len(pending) < self.flush_lines:
+                    continue
+            if pending:
+                self._append("".join(pending))
+                pending = []
+            deadline = None
+            if isinstance(item, threading.Event):
+                item.set()
+    def _append(self, text):
+        try:
+            if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                self._rotate()
+            # A lone surrogate (e.g. from a pasted username) must not cost the batch
+            with open(self.path, "a", encoding="utf-8", errors="backslashreplace") as f:
+                f.write(text)
+        except Exception:
+            pass  # the writer thread has to survive, or every later flush() waits
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+log_sink = LogSink()
+atexit.register(log_sink.flush)
 def write_log(message: str):
-    ts = time.strftime("%Y-%m-%d %H:%M:%S")
-    with open(LOG_FILE, "a", encoding="utf-8") as f:
-        f.write(f"[{ts}] {message}\n")
+    log_sink.write([message])
+def write_logs(messages):
+    if messages:
+        log_sink.write(messages)
+# -----------------------------
+# Util: settings
+# -----------------------------
+def load_settings(path: str = SETTINGS_FILE):
+    settings = dict(DEFAULT_SETTINGS)
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                settings.update(data)
+        except Exception:
+            pass
+    return settings
+def record_startup_time(seconds, path=STARTUP_TIMES):
+    # One JSON line per launch: module import to first frame, per version
+    entry = {"version": APP_VERSION, "at": time.strftime("%Y-%m-%d %H:%M:%S"), "seconds": round(seconds, 4)}
+    try:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+    except OSError:
+        pass
+# -----------------------------
+# Util: metrics
+# -----------------------------
+class _NoTimer:
+    # What Metrics.timed() hands out while disabled: one shared, empty object
+    __slots__ = ()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+NO_TIMER = _NoTimer()
+class OperationStats:
+    # Latencies go into log-spaced buckets (each 10% wider than the last,
+    # from 1 µs), so percentiles come from counts without keeping samples
+    __slots__ = ('count', 'errors', 'total', 'max', 'buckets')
+    FIRST = 1e-6
+    GROWTH = 1.1
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = {}
+    def add(self, seconds, error=False):
+        bucket = math.ceil(math.log(seconds / self.FIRST, self.GROWTH)) if seconds > self.FIRST else 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.errors += error
+        self.total += seconds
+        self.max = max(self.max, seconds)
+    def percentile(self, q):
+        # Upper edge of the bucket holding the q-th latency (at most 10% high)
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.FIRST * self.GROWTH ** bucket, self.max)
+        return self.max
+    def summary(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "total": round(self.total, 9),
+            "mean": round(self.total / self.count, 9) if self.count else 0.0,
+            "p50": round(self.percentile(0.50), 9),
+            "p95": round(self.percentile(0.95), 9),
+            "p99": round(self.percentile(0.99), 9),
+            "max": round(self.max, 9),
+        }
+class _Timer:
+    __slots__ = ('metrics', 'name', 'start', 'profiler')
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+    def __enter__(self):
+        metrics = self.metrics
+        self.profiler = None if metrics.profile_threshold is None else metrics._start_profile()
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        if self.profiler is not None:
+            self.metrics._finish_profile(self.profiler, self.name, elapsed)
+        self.metrics.observe(self.name, elapsed, error=exc_type is not None)
+        return False
+class Metrics:
+    # Call counts and latency histograms per operation name, plus plain
+    # counters. Off by default: timed() then returns NO_TIMER and timer()
+    # wrappers cost one attribute check. With profile_threshold set, the
+    # outermost timed operation on a thread runs under cProfile and its
+    # profile is dumped to profile_dir when it took at least that long.
+    def __init__(self):
+        self.enabled = False
+        self.profile_threshold = None
+        self.profile_dir = PROFILE_DIR
+        self.export_path = None
+        self._ops = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._exporter = None
+    def timed(self, name):
+        return _Timer(self, name) if self.enabled else NO_TIMER
+    def timer(self, name):
+        def wrap(fn):
+            @functools.wraps(fn)
+            def timed_call(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with _Timer(self, name):
+                    return fn(*args, **kwargs)
+            return timed_call
+        return wrap
+    def observe(self, name, seconds, error=False):
+        with self._lock:
+            stats = self._ops.get(name)
+            if stats is None:
+                stats = self._ops[name] = OperationStats()
+            stats.add(seconds, error)
+    def incr(self, name, n=1):
+        if self.enabled:
+            with self._lock:
+                self._counters[name] = self._counters.get(name, 0) + n
+    def reset(self):
+        with self._lock:
+            self._ops.clear()
+            self._counters.clear()
+    def _start_profile(self):
+        if getattr(self._local, "profiling", False):
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return None  # another thread is already being profiled
+        self._local.profiling = True
+        return profiler
+    def _finish_profile(self, profiler, name, elapsed):
+        profiler.disable()
+        self._local.profiling = False
+        if elapsed < self.profile_threshold:
+            return
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            stamp = time.strftime("%Y%m%d-%H%M%S")
+            profiler.dump_stats(os.path.join(self.profile_dir, f"{name}-{stamp}-{elapsed * 1000:.0f}ms.prof"))
+        except OSError:
+            pass
+    # -------- Export ----------
+    def snapshot(self):
+        with self._lock:
+            operations = {name: stats.summary() for name, stats in sorted(self._ops.items())}
+            counters = dict(sorted(self._counters.items()))
+        return {"at": time.strftime("%Y-%m-%d %H:%M:%S"), "operations": operations, "counters": counters}
+    @staticmethod
+    def prometheus_text(snapshot):
+        lines = ["# TYPE catalyst_operation_seconds summary"]
+        for name, stats in snapshot["operations"].items():
+            for key, quantile in (("p50", "0.5"), ("p95", "0.95"), ("p99", "0.99")):
+                lines.append(f'catalyst_operation_seconds{{op="{name}",quantile="{quantile}"}} {stats[key]}')
+            lines.append(f'catalyst_operation_seconds_sum{{op="{name}"}} {stats["total"]}')
+            lines.append(f'catalyst_operation_seconds_count{{op="{name}"}} {stats["count"]}')
+        lines.append("# TYPE catalyst_operation_errors_total counter")
+        for name, stats in snapshot["operations"].items():
+            lines.append(f'catalyst_operation_errors_total{{op="{name}"}} {stats["errors"]}')
+        lines.append("# TYPE catalyst_events_total counter")
+        for name, count in snapshot["counters"].items():
+            lines.append(f'catalyst_events_total{{event="{name}"}} {count}')
+        return "\n".join(lines) + "\n"
+    def write(self, path=None):
+        # JSON, or the Prometheus text format for a path ending in .prom
+        path = path or self.export_path
+        snapshot = self.snapshot()
+        text = self.prometheus_text(snapshot) if path.endswith(".prom") else json.dumps(snapshot, indent=2)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    def start_export(self, path, interval):
+        self.export_path = path
+        if self._exporter is None:
+            self._exporter = threading.Thread(target=self._export_loop, args=(interval,), name="metrics", daemon=True)
+            self._exporter.start()
+    def _export_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.write()
+            except OSError:
+                pass
+    def flush(self):
+        if self.enabled and self.export_path:
+            try:
+                self.write()
+            except OSError:
+                pass
+metrics = Metrics()
+atexit.register(metrics.flush)
+def configure_metrics(settings):
+    metrics.enabled = bool(settings["metrics"])
+    slow_ms = settings["profile_slow_ms"]
+    metrics.profile_threshold = None if slow_ms is None else slow_ms / 1000
+    if metrics.enabled and settings["metrics_file"]:
+        metrics.start_export(settings["metrics_file"], settings["metrics_interval"])
+# -----------------------------
+# Util: background work
+# -----------------------------
+class TkTask:
+    def __init__(self, worker, key, future, timeout):
+        self.worker = worker
+        self.key = key
+        self.future = future
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.on_done = None
+        self.on_error = None
+        self.cancelled = False
+    def cancel(self):
+        self.cancelled = True
+        self.future.cancel()
+        self.worker._forget(self)
+class TkWorker:
+    # Runs callables on daemon threads and reports back on the Tk main loop.
+    # Tk is not thread-safe, so completion is polled with after() rather than
+    # having workers touch widgets. Only one task per key runs at a time.
+    # max_workers=None gives every task its own thread, for calls that can
+    # hang: one abandoned after its timeout then holds up nothing else.
+    POLL_MS = 50
+    def __init__(self, widget, max_workers=2, name="worker"):
+        self.widget = widget
+        self.name = name
+        self._queue = queue.Queue() if max_workers else None
+        self._tasks = {}
+        self._poll_job = None
+        for i in range(max_workers or 0):
+            threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True).start()
+    def _run(self):
+        while True:
+            self._execute(*self._queue.get())
+    @staticmethod
+    def _execute(future, fn, args):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+    def busy(self, key):
+        return key in self._tasks
+    def submit(self, key, fn, *args, on_done=None, on_error=None, timeout=None):
+        # Returns None if a task with the same key is still in flight
+        if key in self._tasks:
+            return None
+        future = Future()
+        task = TkTask(self, key, future, timeout)
+        task.on_done = on_done
+        task.on_error = on_error
+        self._tasks[key] = task
+        if self._queue is None:
+            threading.Thread(target=self._execute, args=(future, fn, args), name=f"{self.name}-{key}", daemon=True).start()
+        else:
+            self._queue.put((future, fn, args))
+        if self._poll_job is None:
+            self._poll_job = self.widget.after(self.POLL_MS, self._poll)
+        return task
+    def _forget(self, task):
+        if self._tasks.get(task.key) is task:
+            del self._tasks[task.key]
+    def _poll(self):
+        self._poll_job = None
+        now = time.monotonic()
+        for task in list(self._tasks.values()):
+            if task.future.done():
+                self._finish(task, None if task.future.cancelled() else task.future.exception())
+            elif task.deadline is not None and now >= task.deadline:
+                task.future.cancel()
+                self._finish(task, TimeoutError(f"no response after {task.timeout:g} seconds"))
+        if self._tasks:
+            self._poll_job = self.widget.after(self.POLL_MS, self._poll)
+    def _finish(self, task, error):
+        self._forget(task)
+        if task.cancelled:
+            return
+        if error is None:
+            if task.on_done:
+                task.on_done(task.future.result())
+        elif task.on_error:
+            task.on_error(error)
+class StallWatchdog:
+    # The Tk thread stamps a heartbeat every `interval` seconds via after();
+    # a side thread watches the stamp. Once the loop has been silent for
+    # `threshold` seconds it grabs the Tk thread's stack, and when the loop
+    # comes back the stall is reported with its length and the handler that
+    # was running (the first catalyst frame entered from a Tk callback).
+    def __init__(self, widget, threshold=0.25, interval=0.05, path=STALL_REPORT, keep=50):
+        self.widget = widget
+        self.threshold = threshold
+        self.interval = interval
+        self.path = path
+        self.stalls = deque(maxlen=keep)
+        self._tk_thread = None
+        self._beat = time.monotonic()
+        self._captured = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+    def start(self):
+        # Call on the Tk thread
+        self._tk_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self.widget.after(int(self.interval * 1000), self._heartbeat)
+        threading.Thread(target=self._watch, name="stall-watchdog", daemon=True).start()
+    def stop(self):
+        self._stop.set()
+    def _heartbeat(self):
+        if self._stop.is_set():
+            return
+        now = time.monotonic()
+        with self._lock:
+            lag = now - self._beat - self.interval
+            captured, self._captured = self._captured, None
+            self._beat = now
+        if metrics.enabled:
+            metrics.observe("ui.loop_lag", max(lag, 0.0))
+        if lag >= self.threshold:
+            self._report(lag, captured)
+        self.widget.after(int(self.interval * 1000), self._heartbeat)
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                if self._captured is not None or time.monotonic() - self._beat - self.interval < self.threshold:
+                    continue
+                frame = sys._current_frames().get(self._tk_thread)
+                self._captured = self._describe(frame) if frame is not None else None
+                del frame
+    @staticmethod
+    def _describe(frame):
+        frames = []
+        while frame is not None:
+            frames.append(frame)
+            frame = frame.f_back
+        frames.reverse()
+        ours = os.path.basename(__file__)
+        tk_dir = os.path.dirname(tk.__file__)
+        handler = where = None
+        inside_tk = False
+        for f in frames:
+            filename = f.f_code.co_filename
+            if filename.startswith(tk_dir):
+                inside_tk = True
+            elif os.path.basename(filename) == ours:
+                name = getattr(f.f_code, "co_qualname", f.f_code.co_name)
+                if f.f_code.co_name in ("timed_call", "locked"):
+                    continue  # Metrics.timer / shared_mutation wrapper, not the handler itself
+                if inside_tk and handler is None:
+                    handler = name
+                where = f"{name}:{f.f_lineno}"
+        stack = traceback.format_list(traceback.extract_stack(frames[-1], limit=20))
+        return {"handler": handler or "unknown", "where": where or "unknown", "stack": stack}
+    def _report(self, lag, captured):
+        captured = captured or {"handler": "unknown", "where": "unknown", "stack": []}
+        entry = {"at": time.strftime("%Y-%m-%d %H:%M:%S"), "seconds": round(lag, 3), **captured}
+        self.stalls.append(entry)
+        write_log(f"UI stalled for {lag:.2f}s in {entry['handler']} (at {entry['where']})")
+        if metrics.enabled:
+            metrics.observe("ui.stall", lag)
+        # Rolling report: the last `keep` stalls, one JSON line each
+        try:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(stall) + "\n" for stall in self.stalls)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+# -----------------------------
+# Util: file locks
+# -----------------------------
+class FileLock:
+    # Advisory lock on a sidecar file, shared by every Catalyst process using
+    # the same data directory (flock on POSIX, msvcrt.locking on Windows),
+    # given up with TimeoutError after `timeout` seconds on both.
+    # Re-entrant for the thread holding it; other threads of this process
+    # wait on the in-process lock first.
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self.depth = 0
+        self._lock = threading.RLock()
+        self._file = None
+    def __enter__(self):
+        self._lock.acquire()
+        if self.depth == 0:
+            try:
+                self._lock_file()
+            except BaseException:
+                self._lock.release()
+                raise
+        self.depth += 1
+        return self
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0:
+            self._unlock_file()
+        self._lock.release()
+        return False
+    def _lock_file(self):
+        f = open(self.path, "a+b")
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                if msvcrt is None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                break
+            except OSError:
+                if time.monotonic() >= deadline:
+                    f.close()
+                    raise TimeoutError(f"could not lock {self.path} within {self.timeout:g} seconds")
+                time.sleep(0.005)
+        self._file = f
+    def _unlock_file(self):
+        f, self._file = self._file, None
+        if msvcrt is None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        f.close()
 # -----------------------------
 # Auth storage helpers
 # -----------------------------
-def load_users():
-    if not os.path.exists(USERS_FILE):
+def load_users(path: str = USERS_FILE):
+    if not os.path.exists(path):
         return []
     try:
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
+        with open(path, "r", encoding="utf-8") as f:
             data = json.load(f)
             if isinstance(data, list):
                 return data
             return []
     except Exception:
         return []
-def save_users(users):
-    with open(USERS_FILE, "w", encoding="utf-8") as f:
+def save_users(users, path: str = USERS_FILE):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
         json.dump(users, f, indent=2)
+    os.replace(tmp, path)
+class UserStore:
+    # logins.json parsed once into a dict keyed by username. The file is
+    # re-read only when its mtime/size changes, e.g. after another instance
+    # signed someone up. Used from the auth worker threads, hence the lock.
+    # With shared=True writes also hold logins.json.lock and re-read the file
+    # first, so two processes signing up at once both keep their account.
+    def __init__(self, path: str = USERS_FILE, shared: bool = False):
+        self.path = path
+        self._users = []
+        self._by_name = {}
+        self._stamp = None
+        self._lock = threading.RLock()
+        self._file_lock = FileLock(path + ".lock") if shared else None
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+    def _refresh(self):
+        stamp = self._file_stamp()
+        if stamp == self._stamp:
+            return
+        self._users = load_users(self.path)
+        self._by_name = {}
+        for user in self._users:
+            self._by_name.setdefault(user.get("user_hash", ""), user)
+        self._stamp = stamp
+    def _save(self):
+        save_users(self._users, self.path)
+        self._stamp = self._file_stamp()
+    @contextmanager
+    def _writing(self):
+        with self._lock:
+            if self._file_lock is None:
+                self._refresh()
+                yield
+                return
+            with self._file_lock:
+                # mtime/size can miss a same-size rewrite within one tick
+                self._stamp = None
+                self._refresh()
+                yield
+    def find(self, username: str):
+        with self._lock:
+            self._refresh()
+            return self._by_name.get(username)
+    def add(self, record):
+        # Returns False if the username was taken in the meantime
+        with self._writing():
+            name = record.get("user_hash", "")
+            if name in self._by_name:
+                return False
+            self._users.append(record)
+            self._by_name[name] = record
+            self._save()
+            return True
+    def update(self, username: str, **fields):
+        with self._writing():
+            record = self._by_name.get(username)
+            if record is None:
+                return False
+            record.update(fields)
+            self._save()
+            return True
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._users)
+def open_database(path: str = DATABASE_FILE):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+class SqliteUserStore:
+    # Same interface as UserStore; one row per account, looked up by key
+    def __init__(self, path: str = DATABASE_FILE):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = open_database(path)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS users (user_hash TEXT PRIMARY KEY, pass_hash TEXT NOT NULL)")
+    def find(self, username: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT user_hash, pass_hash FROM users WHERE user_hash = ?", (username,)
+            ).fetchone()
+        return {"user_hash": row[0], "pass_hash": row[1]} if row else None
+    def add(self, record):
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO users (user_hash, pass_hash) VALUES (?, ?)",
+                (record.get("user_hash", ""), record.get("pass_hash", "")),
+            )
+            return cur.rowcount == 1
+    def update(self, username: str, **fields):
+        if set(fields) - {"pass_hash"}:
+            raise ValueError(f"unknown user fields: {sorted(fields)}")
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "UPDATE users SET pass_hash = ? WHERE user_hash = ?", (fields.get("pass_hash"), username)
+            )
+            return cur.rowcount == 1
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    def close(self):
+        with self._lock:
+            self._conn.close()
+def make_user_store(settings):
+    if settings.get("storage") == "sqlite":
+        return SqliteUserStore(DATABASE_FILE)
+    return UserStore(USERS_FILE, shared=settings.get("storage") == "shared")
+def use_user_store(store):
+    global user_store
+    user_store = store
+user_store = UserStore()
 def find_user_record_by_username(plain_username: str):
-    users = load_users()
-    for user in users:
-        user_hash = user.get("user_hash", "")
-        if user_hash == plain_username:
-            return user
-    return None
-def add_user(plain_username: str, plain_password: str):
-    users = load_users()
+    return user_store.find(plain_username)
+@metrics.timer("auth.add_user")
+def add_user(plain_username: str, plain_password: str, rounds: int = DEFAULT_SETTINGS["bcrypt_rounds"]):
     # Check if exists
     if find_user_record_by_username(plain_username) is not None:
         return False, "Username already exists."
     # Hash both username and password
     user_hash = plain_username
-    pass_hash = bcrypt.hashpw(plain_password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
-    users.append({"user_hash": user_hash, "pass_hash": pass_hash})
-    save_users(users)
+    pass_hash = bcrypt.hashpw(plain_password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+    if not user_store.add({"user_hash": user_hash, "pass_hash": pass_hash}):
+        return False, "Username already exists."
     write_log(f"Signup success for user '{plain_username}'")
     return True, "Signup successful."
 # -----------------------------
-def verify_user(plain_username: str, plain_password: str):
+def bcrypt_cost(pass_hash: str):
+    # "$2b$12$..." -> 12
+    try:
+        return int(pass_hash.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+def calibrate_bcrypt_rounds(target_seconds: float, min_rounds: int = 10, max_rounds: int = 16):
+    # Each extra round doubles the cost, so one timing at min_rounds predicts
+    # the rest; pick the slowest cost that still fits the target latency
+    start = time.perf_counter()
+    bcrypt.hashpw(b"calibration", bcrypt.gensalt(min_rounds))
+    elapsed = time.perf_counter() - start
+    rounds = min_rounds
+    while rounds < max_rounds and elapsed * 2 <= target_seconds:
+        elapsed *= 2
+        rounds += 1
+    return rounds
+@metrics.timer("auth.verify_user")
+def verify_user(plain_username: str, plain_password: str, rounds: int | None = None):
     user_rec = find_user_record_by_username(plain_username)
     if not user_rec:
         write_log(f"Login failed (user not found) for '{plain_username}'")
@@ -68,6 +799,11 @@ def verify_user(plain_username: str, plain_password: str):
         ok = False
     if ok:
         write_log(f"Login success for '{plain_username}'")
+        # The plaintext is only available here, so upgrade the stored hash now
+        if rounds is not None and bcrypt_cost(pass_hash) != rounds:
+            new_hash = bcrypt.hashpw(plain_password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+            user_store.update(plain_username, pass_hash=new_hash)
+            write_log(f"Rehashed password for '{plain_username}' at cost {rounds}")
         return True
     else:
         write_log(f"Login failed (bad password) for '{plain_username}'")
@@ -76,91 +812,2038 @@ def verify_user(plain_username: str, plain_password: str):
 # Book Class
 # -----------------------------
 class Book:
-    def __init__(self, title, author, available=True, borrowed_by=None):
+    __slots__ = ('title', 'author', 'available', 'borrowed_by', 'checked_out_at', 'due_at', 'book_id')
+    def __init__(self, title, author, available=True, borrowed_by=None, checked_out_at=None, due_at=None):
         self.title = title
-        self.author = author
+        # Many copies share an author; keep one string per distinct name
+        self.author = sys.intern(author) if type(author) is str else author
         self.available = available
         self.borrowed_by = borrowed_by
+        # Epoch seconds of the current loan, None when on the shelf (or for
+        # loans recorded before due dates existed)
+        self.checked_out_at = checked_out_at
+        self.due_at = due_at
+        # Position in Library.books, assigned by the library (not persisted)
+        self.book_id = None
     def to_dict(self):
         return {
             'title': self.title,
             'author': self.author,
             'available': self.available,
-            'borrowed_by': self.borrowed_by
+            'borrowed_by': self.borrowed_by,
+            'checked_out_at': self.checked_out_at,
+            'due_at': self.due_at
         }
+class TitleRecord:
+    # All copies of one book (title + author): copy ids in catalog order plus
+    # the pool of ids currently on the shelf, so lending any copy is a set pop
+    __slots__ = ('title', 'author', 'copies', 'available')
+    def __init__(self, title, author):
+        self.title = title
+        self.author = author
+        self.copies = []
+        self.available = set()
+    @staticmethod
+    def row_key(title, author):
+        return f"title:{title}\n{author}"
+    @property
+    def row_id(self):
+        return self.row_key(self.title, self.author)
+JSON_SPACE = re.compile(r"[ \t\r\n]*")
+def iter_json_array(f, chunk_size=1 << 20):
+    # Elements of the top-level JSON array in text file f, decoded one at a
+    # time so the whole document is never in memory
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+    state = "open"  # then "item_or_end", "item" (after a comma), "sep"
+    while True:
+        pos = JSON_SPACE.match(buf, pos).end()
+        if pos < len(buf):
+            ch = buf[pos]
+            if state == "open":
+                if ch != "[":
+                    raise ValueError("expected a JSON array")
+                pos, state = pos + 1, "item_or_end"
+                continue
+            if ch == "]" and state in ("item_or_end", "sep"):
+                return
+            if state == "sep":
+                if ch != ",":
+                    raise ValueError(f"expected ',' or ']' in JSON array, got {ch!r}")
+                pos, state = pos + 1, "item"
+                continue
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # A value touching the end of the buffer may continue in the next chunk
+                if end < len(buf) or eof:
+                    yield value
+                    pos, state = end, "sep"
+                    continue
+        elif eof:
+            raise ValueError("JSON array is not closed")
+        chunk = f.read(chunk_size)
+        buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+def expand_inventory(records):
+    # Older inventory-style records {"title", "author", "copies": N} become
+    # N per-copy rows, the format books.json is written in
+    if not any("copies" in record for record in records):
+        return records
+    rows = []
+    bad = 0
+    for record in records:
+        if "copies" not in record:
+            rows.append(record)
+            continue
+        try:
+            copies = int(record["copies"])
+        except (TypeError, ValueError):
+            # Keep the book rather than lose it on the next save
+            bad += 1
+            copies = 1
+        base = {k: v for k, v in record.items() if k != "copies"}
+        base.setdefault("available", True)
+        base.setdefault("borrowed_by", None)
+        rows.extend(dict(base) for _ in range(copies))
+    if bad:
+        write_log(f"{bad} inventory record(s) had a copies value that is not a number; loaded one copy each")
+    return rows
+def _set_sparse(column, book_id, value):
+    if value is None:
+        column.pop(book_id, None)
+    else:
+        column[book_id] = value
+class BookView:
+    # Book-like handle onto one row of a ColumnarBooks store
+    __slots__ = ('_store', 'book_id')
+    def __init__(self, store, book_id):
+        self._store = store
+        self.book_id = book_id
+    @property
+    def title(self):
+        return self._store.titles[self.book_id]
+    @title.setter
+    def title(self, value):
+        self._store.titles[self.book_id] = value
+    @property
+    def author(self):
+        return self._store.authors[self._store.author_ids[self.book_id]]
+    @author.setter
+    def author(self, value):
+        self._store.author_ids[self.book_id] = self._store.author_id(value)
+    @property
+    def available(self):
+        return self._store.is_available(self.book_id)
+    @available.setter
+    def available(self, value):
+        self._store.set_available(self.book_id, value)
+    @property
+    def borrowed_by(self):
+        return self._store.borrowers.get(self.book_id)
+    @borrowed_by.setter
+    def borrowed_by(self, value):
+        if value is None:
+            self._store.borrowers.pop(self.book_id, None)
+        else:
+            self._store.borrowers[self.book_id] = value
+    @property
+    def checked_out_at(self):
+        return self._store.checked_out.get(self.book_id)
+    @checked_out_at.setter
+    def checked_out_at(self, value):
+        _set_sparse(self._store.checked_out, self.book_id, value)
+    @property
+    def due_at(self):
+        return self._store.due.get(self.book_id)
+    @due_at.setter
+    def due_at(self, value):
+        _set_sparse(self._store.due, self.book_id, value)
+    def to_dict(self):
+        return Book.to_dict(self)
+class ColumnarBooks:
+    # Catalog as parallel columns: titles, an author id per book pointing into
+    # a table of distinct authors, one bit per book for `available`, and
+    # sparse dicts for borrowers and loan times. Indexing hands out BookView objects, so
+    # callers of Library.books can treat it like the list of Book.
+    def __init__(self):
+        self.titles = []
+        self.authors = []
+        self._author_index = {}
+        self.author_ids = array('I')
+        self.flags = bytearray()
+        self.borrowers = {}
+        self.checked_out = {}
+        self.due = {}
+    def author_id(self, author):
+        author_id = self._author_index.get(author)
+        if author_id is None:
+            author_id = self._author_index[author] = len(self.authors)
+            self.authors.append(author)
+        return author_id
+    def is_available(self, book_id):
+        return bool(self.flags[book_id >> 3] & (1 << (book_id & 7)))
+    def set_available(self, book_id, value):
+        if value:
+            self.flags[book_id >> 3] |= 1 << (book_id & 7)
+        else:
+            self.flags[book_id >> 3] &= ~(1 << (book_id & 7)) & 0xFF
+    def append(self, book):
+        book_id = len(self.titles)
+        if book_id & 7 == 0:
+            self.flags.append(0)
+        self.titles.append(book.title)
+        self.author_ids.append(self.author_id(book.author))
+        self.set_available(book_id, book.available)
+        if book.borrowed_by is not None:
+            self.borrowers[book_id] = book.borrowed_by
+        if book.checked_out_at is not None:
+            self.checked_out[book_id] = book.checked_out_at
+        if book.due_at is not None:
+            self.due[book_id] = book.due_at
+    def __len__(self):
+        return len(self.titles)
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [BookView(self, i) for i in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("book index out of range")
+        return BookView(self, key)
+    def __iter__(self):
+        for i in range(len(self)):
+            yield BookView(self, i)
+    def __delitem__(self, key):
+        # Only dropping a tail is supported (transaction rollback)
+        start = key.indices(len(self))[0] if isinstance(key, slice) else key
+        for book_id in range(start, len(self)):
+            self.borrowers.pop(book_id, None)
+            self.checked_out.pop(book_id, None)
+            self.due.pop(book_id, None)
+        del self.titles[start:]
+        del self.author_ids[start:]
+        del self.flags[(start + 7) >> 3:]
+# -----------------------------
+# Search index
+# -----------------------------
+class SearchIndex:
+    # Trigram and whitespace-token postings over "title\nauthor", lowercased.
+    # Postings are arrays of book ids in ascending order; candidates found by
+    # intersecting them are verified against the cached lowercase text, so
+    # results are exactly the substring matches of the old linear scan.
+    def __init__(self):
+        self._text = []
+        self._trigrams = {}
+        self._tokens = {}
+    @staticmethod
+    def _keys(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}, set(text.split())
+    def add(self, book_id, title, author):
+        text = f"{title}\n{author}".lower()
+        while len(self._text) <= book_id:
+            self._text.append(None)
+        self._text[book_id] = text
+        grams, tokens = self._keys(text)
+        for keys, index in ((grams, self._trigrams), (tokens, self._tokens)):
+            for key in keys:
+                # No throwaway array per key: most keys already have postings
+                postings = index.get(key)
+                if postings is None:
+                    postings = index[key] = array('I')
+                postings.append(book_id)
+    def remove(self, book_id):
+        grams, tokens = self._keys(self._text[book_id])
+        for keys, index in ((grams, self._trigrams), (tokens, self._tokens)):
+            for key in keys:
+                postings = index[key]
+                if postings[-1] == book_id:
+                    postings.pop()
+                else:
+                    postings.remove(book_id)
+                if not postings:
+                    del index[key]
+        if book_id == len(self._text) - 1:
+            self._text.pop()
+        else:
+            self._text[book_id] = None
+    def search(self, keyword, within=None):
+        # Ranked: title prefix, then word start in title, then other title
+        # matches, then author-only matches; catalog order within each group.
+        # `within` (ids matching a substring of keyword) stands in for the
+        # index candidates when refining a previous search leaves fewer.
+        keyword = keyword.lower()
+        text = self._text
+        postings = self._postings(keyword)
+        if within is not None and (not postings or len(within) <= len(postings[0])):
+            candidates = within
+        else:
+            candidates = self._candidates(postings)
+        candidates = range(len(text)) if candidates is None else sorted(candidates)
+        hits = [i for i in candidates if text[i] is not None and keyword in text[i]]
+        if "\n" in keyword:
+            hits = [i for i in hits if any(keyword in f for f in text[i].split("\n", 1))]
+        return self._rank(keyword, hits)
+    def first(self, keyword, limit, within=None):
+        # The first `limit` matches in catalog order, ranked among
+        # themselves: enough to fill the table while search() runs. Walks
+        # the shortest postings list and stops early.
+        keyword = keyword.lower()
+        text = self._text
+        postings = self._postings(keyword)
+        if within is not None and (not postings or len(within) <= len(postings[0])):
+            candidates = sorted(within)
+        else:
+            candidates = postings[0] if postings else range(len(text))
+        hits = []
+        for i in candidates:
+            match = text[i]
+            if match is None or keyword not in match:
+                continue
+            if "\n" in keyword and not any(keyword in f for f in match.split("\n", 1)):
+                continue
+            hits.append(i)
+            if len(hits) >= limit:
+                break
+        return self._rank(keyword, hits)
+    def _rank(self, keyword, hits):
+        text = self._text
+        groups = ([], [], [], [])
+        word = " " + keyword
+        for i in hits:
+            title = text[i].split("\n", 1)[0]
+            if title.startswith(keyword):
+                groups[0].append(i)
+            elif word in title:
+                groups[1].append(i)
+            elif keyword in title:
+                groups[2].append(i)
+            else:
+                groups[3].append(i)
+        return groups[0] + groups[1] + groups[2] + groups[3]
+    def _postings(self, keyword):
+        # Every postings list a match must appear in, shortest first
+        postings = []
+        # Words enclosed by spaces in the query must be whole tokens of a
+        # match; split like the text was, so "a\tb" needs tokens a and b
+        words = keyword.split(" ")
+        for word in words[1:-1]:
+            for token in word.split():
+                postings.append(self._tokens.get(token, ()))
+        postings.extend(self._trigrams.get(keyword[i:i + 3], ()) for i in range(len(keyword) - 2))
+        postings.sort(key=len)
+        return postings
+    @staticmethod
+    def _candidates(postings):
+        if not postings:
+            return None
+        candidates = set(postings[0])
+        for other in postings[1:]:
+            if len(candidates) < 32:
+                break
+            candidates.intersection_update(other)
+        return candidates
+# -----------------------------
+# Duplicate detection
+# -----------------------------
+ARTICLES = {"the", "a", "an"}
+# A trailing article only counts when it was moved there: "Worlds, The"
+INVERTED_ARTICLE = re.compile(r",\s*(the|a|an)\s*$", re.IGNORECASE)
+def normalize_words(text):
+    # Case, accents and punctuation folded away; whitespace collapsed
+    text = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(ch if ch.isalnum() else " " for ch in text if not unicodedata.combining(ch)).split()
+def duplicate_key(title, author):
+    # "War of the Worlds, The" and "The War of the Worlds" share a key
+    # while "Plan A" keeps its "a"
+    words = normalize_words(title)
+    if len(words) > 1 and words[0] in ARTICLES:
+        words = words[1:]
+    if len(words) > 1 and words[-1] in ARTICLES and INVERTED_ARTICLE.search(title):
+        words = words[:-1]
+    return " ".join(words) + "|" + " ".join(normalize_words(author))
+class NearDuplicateIndex:
+    # MinHash signatures of character 3-shingles of the duplicate key, with
+    # LSH banding to find candidates; candidates are confirmed by the exact
+    # shingle Jaccard similarity. 8 bands of 4 rows: a pair at the 0.7
+    # threshold shares a band ~89% of the time (0.8: ~98%), one at 0.2
+    # only ~1%, so few candidates need the exact check.
+    PRIME = (1 << 61) - 1
+    def __init__(self, num_hashes=32, bands=8, threshold=0.7):
+        self.rows = num_hashes // bands
+        self.threshold = threshold
+        coeffs = [zlib.crc32(f"minhash{i}".encode()) for i in range(2 * num_hashes)]
+        self._coeffs = [(coeffs[2 * i] | 1, coeffs[2 * i + 1]) for i in range(num_hashes)]
+        self._buckets = [{} for _ in range(bands)]
+        self._keys = {}
+        # shingle -> its num_hashes hash values; titles share most shingles,
+        # so a signature is mostly a column-wise min over cached rows
+        self._hashes = {}
+    @staticmethod
+    def _shingles(key):
+        key = f" {key} "
+        return {key[i:i + 3] for i in range(len(key) - 2)}
+    def _bands(self, shingles):
+        cache = self._hashes
+        columns = []
+        for shingle in shingles:
+            row = cache.get(shingle)
+            if row is None:
+                h = zlib.crc32(shingle.encode("utf-8"))
+                row = cache[shingle] = array('I', [(a * h + b) % self.PRIME & 0xFFFFFFFF for a, b in self._coeffs])
+            columns.append(row)
+        signature = list(map(min, zip(*columns)))
+        rows = self.rows
+        return [tuple(signature[i:i + rows]) for i in range(0, len(signature), rows)]
+    def add(self, book_id, key):
+        self._keys[book_id] = key
+        for buckets, band in zip(self._buckets, self._bands(self._shingles(key))):
+            buckets.setdefault(band, []).append(book_id)
+    def remove(self, book_id):
+        key = self._keys.pop(book_id, None)
+        if key is None:
+            return
+        for buckets, band in zip(self._buckets, self._bands(self._shingles(key))):
+            ids = buckets.get(band)
+            if ids and book_id in ids:
+                ids.remove(book_id)
+                if not ids:
+                    del buckets[band]
+    def find(self, key):
+        shingles = self._shingles(key)
+        candidates = set()
+        for buckets, band in zip(self._buckets, self._bands(shingles)):
+            candidates.update(buckets.get(band, ()))
+        found = []
+        # Copies share a key; check each key once
+        similar = {}
+        for book_id in sorted(candidates):
+            key = self._keys[book_id]
+            if key not in similar:
+                other = self._shingles(key)
+                similar[key] = len(shingles & other) / len(shingles | other) >= self.threshold
+            if similar[key]:
+                found.append(book_id)
+        return found
+# -----------------------------
+# Loan scheduling
+# -----------------------------
+class LoanScheduler:
+    # Min-heap of (due_at, book_id) for open loans that are not overdue yet.
+    # Cancelling only drops the id from `_due`; the stale heap entry is
+    # skipped when it reaches the top, and the heap is rebuilt once stale
+    # entries outnumber live ones. Loans popped by pop_due move to `overdue`.
+    def __init__(self):
+        self._heap = []
+        self._due = {}
+        self.overdue = {}
+    def __len__(self):
+        return len(self._due) + len(self.overdue)
+    def schedule(self, book_id, due_at):
+        self.cancel(book_id)
+        self._due[book_id] = due_at
+        heapq.heappush(self._heap, (due_at, book_id))
+    def cancel(self, book_id):
+        if self._due.pop(book_id, None) is None:
+            self.overdue.pop(book_id, None)
+        elif len(self._heap) > 2 * len(self._due) + 64:
+            self._heap = [(due_at, i) for i, due_at in self._due.items()]
+            heapq.heapify(self._heap)
+    def _prune(self):
+        heap = self._heap
+        while heap and self._due.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+    def next_due(self):
+        # (due_at, book_id) of the loan that becomes overdue next, or None
+        self._prune()
+        return self._heap[0] if self._heap else None
+    def pop_due(self, now):
+        fired = []
+        while True:
+            self._prune()
+            if not self._heap or self._heap[0][0] > now:
+                return fired
+            due_at, book_id = heapq.heappop(self._heap)
+            del self._due[book_id]
+            self.overdue[book_id] = due_at
+            fired.append(book_id)
+# -----------------------------
+# Binary snapshot
+# -----------------------------
+# books.bin layout (little endian):
+#   header   "CATB", u16 version, 2 pad bytes, u64 record count, then the
+#            u64 size and i64 mtime (ns) of the books.json it was built from
+#   offsets  u64 * (count + 1), record start relative to the data section
+#   data     per record: u8 flags (1 = available, 2 = has borrower),
+#            u16 title/author/borrower byte lengths, f64 checked_out_at and
+#            due_at (NaN when unset), then the UTF-8 bytes
+#   loans    u64 count, then u64 id + f64 due_at per open loan with a due
+#            date, so the overdue heap can be filled without decoding books
+SNAPSHOT_HEADER = struct.Struct("<4sHxxQQq")
+SNAPSHOT_RECORD = struct.Struct("<BHHHdd")
+SNAPSHOT_LOAN = struct.Struct("<Qd")
+SNAPSHOT_MAGIC = b"CATB"
+SNAPSHOT_VERSION = 4
+def file_stamp(path):
+    # (size, mtime in ns) of a path or open file descriptor
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+def write_binary_snapshot(path, records, source=(0, 0)):
+    # source: file_stamp() of the books.json the records were read from
+    data = bytearray()
+    offsets = array('Q')
+    loans = bytearray()
+    for book_id, record in enumerate(records):
+        offsets.append(len(data))
+        title = record["title"].encode("utf-8")
+        author = record["author"].encode("utf-8")
+        borrower = record["borrowed_by"]
+        borrower = b"" if borrower is None else str(borrower).encode("utf-8")
+        flags = (1 if record["available"] else 0) | (2 if record["borrowed_by"] is not None else 0)
+        checked_out_at = record.get("checked_out_at")
+        due_at = record.get("due_at")
+        data += SNAPSHOT_RECORD.pack(
+            flags, len(title), len(author), len(borrower),
+            math.nan if checked_out_at is None else checked_out_at, math.nan if due_at is None else due_at,
+        )
+        data += title + author + borrower
+        if flags & 2 and due_at is not None:
+            loans += SNAPSHOT_LOAN.pack(book_id, due_at)
+    offsets.append(len(data))
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(offsets) - 1, *source))
+        f.write(offsets.tobytes())
+        f.write(data)
+        f.write(struct.pack("<Q", len(loans) // SNAPSHOT_LOAN.size))
+        f.write(loans)
+    os.replace(tmp, path)
+class SnapshotBooks:
+    # Read-only memory map of books.bin that decodes a Book the first time
+    # its index is accessed. Replaced or appended books are kept in Python.
+    # With source given, a snapshot built from another books.json is refused.
+    def __init__(self, path, source=None):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, count, *built_from = SNAPSHOT_HEADER.unpack_from(self._mm, 0)
+        except struct.error:
+            magic = version = None
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            self._mm.close()
+            raise ValueError(f"{path} is not a version {SNAPSHOT_VERSION} book snapshot")
+        if source is not None and tuple(built_from) != tuple(source):
+            self._mm.close()
+            raise ValueError(f"{path} was built from another version of the catalog")
+        self._count = count
+        start = SNAPSHOT_HEADER.size
+        self._offsets = memoryview(self._mm)[start:start + 8 * (count + 1)].cast('Q')
+        self._data = start + 8 * (count + 1)
+        self._loans = self._data + self._offsets[count]
+        self._decoded = {}
+        self._extra = []
+    def _decode(self, i):
+        mm = self._mm
+        pos = self._data + self._offsets[i]
+        flags, title_len, author_len, borrower_len, checked_out_at, due_at = SNAPSHOT_RECORD.unpack_from(mm, pos)
+        pos += SNAPSHOT_RECORD.size
+        title = mm[pos:pos + title_len].decode("utf-8")
+        pos += title_len
+        author = mm[pos:pos + author_len].decode("utf-8")
+        pos += author_len
+        borrower = mm[pos:pos + borrower_len].decode("utf-8") if flags & 2 else None
+        book = Book(
+            title, author, bool(flags & 1), borrower,
+            None if math.isnan(checked_out_at) else checked_out_at, None if math.isnan(due_at) else due_at,
+        )
+        book.book_id = i
+        return book
+    def due_dates(self):
+        # (book_id, due_at) of open loans: the loan table for books never
+        # decoded, the Book itself for decoded (possibly changed) and added ones
+        (count,) = struct.unpack_from("<Q", self._mm, self._loans)
+        start = self._loans + 8
+        for book_id, due_at in SNAPSHOT_LOAN.iter_unpack(self._mm[start:start + count * SNAPSHOT_LOAN.size]):
+            if book_id not in self._decoded:
+                yield book_id, due_at
+        books = list(self._decoded.items()) + list(enumerate(self._extra, self._count))
+        for book_id, book in books:
+            if book.borrowed_by is not None and book.due_at is not None:
+                yield book_id, book.due_at
+    def __len__(self):
+        return self._count + len(self._extra)
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if key >= self._count:
+            return self._extra[key - self._count]
+        if key < 0:
+            raise IndexError("book index out of range")
+        book = self._decoded.get(key)
+        if book is None:
+            # setdefault: a search worker decoding the same record at the
+            # same time must end up with the same Book as the Tk thread
+            book = self._decoded.setdefault(key, self._decode(key))
+        return book
+    def __setitem__(self, key, book):
+        # Used when a journal replays a newer state for a snapshot record
+        if isinstance(book, dict):
+            book = Book(**book)
+        book.book_id = key
+        if key < self._count:
+            self._decoded[key] = book
+        else:
+            self._extra[key - self._count] = book
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    def append(self, book):
+        if isinstance(book, dict):
+            book = Book(**book)
+        self._extra.append(book)
+    def __delitem__(self, key):
+        # Only dropping appended books is supported (transaction rollback)
+        start = key.indices(len(self))[0] if isinstance(key, slice) else key
+        if start < self._count:
+            raise IndexError("cannot delete books stored in the snapshot")
+        del self._extra[start - self._count:]
+    def close(self):
+        self._offsets.release()
+        self._mm.close()
+# -----------------------------
+# Book storage
+# -----------------------------
+class JsonBookStorage:
+    def __init__(self, path=BOOKS_FILE, binary_snapshot=False):
+        self.path = path
+        self.snapshot_path = os.path.splitext(path)[0] + ".bin" if binary_snapshot else None
+    def load(self):
+        if not os.path.exists(self.path):
+            return []
+        snapshot = self.snapshot_path
+        if snapshot and os.path.exists(snapshot):
+            try:
+                return SnapshotBooks(snapshot, source=file_stamp(self.path))
+            except (OSError, ValueError, struct.error):
+                pass
+        with open(self.path, 'r', encoding="utf-8") as f:
+            stamp = file_stamp(f.fileno())
+            records = expand_inventory(json.load(f))
+        if snapshot:
+            # Rebuild the stale/missing snapshot off the startup path, from a
+            # copy since journal replay goes on to change `records`. If books.json
+            # is saved meanwhile, the stamp no longer matches and it is ignored.
+            threading.Thread(target=write_binary_snapshot, args=(snapshot, list(records), stamp), name="snapshot").start()
+        return records
+    def save(self, books):
+        self._write_snapshot([book.to_dict() for book in books])
+    def commit(self, books, changed):
+        self.save(books)
+    def iter_records(self):
+        # Streams books.json one record at a time (for export)
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding="utf-8") as f:
+            for record in iter_json_array(f):
+                yield from expand_inventory([record])
+    def close(self):
+        pass
+    def _write_snapshot(self, records):
+        tmp = self.path + ".tmp"
+        self._dump_snapshot(records, tmp)
+        self._replace_snapshot(tmp)
+    @staticmethod
+    def _dump_snapshot(records, tmp):
+        with open(tmp, 'w', encoding="utf-8") as f:
+            json.dump(records, f, indent=4)
+    def _replace_snapshot(self, tmp):
+        os.replace(tmp, self.path)
+        if self.snapshot_path:
+            try:
+                os.remove(self.snapshot_path)  # stale now; rebuilt on the next load
+            except OSError:
+                pass  # still mapped (Windows); its stamp rules it out anyway
+class JournalBookStorage(JsonBookStorage):
+    # books.json is the snapshot; every mutation appends one JSON line
+    # {"op": "add"|"update", "id": <position>, "book": {...}} to the journal.
+    # Records carry the full book state, so replaying them is idempotent and
+    # a snapshot that already contains some of them is still consistent.
+    def __init__(self, path=BOOKS_FILE, journal_path=BOOKS_JOURNAL,
+                 max_records=DEFAULT_SETTINGS["journal_max_records"],
+                 max_bytes=DEFAULT_SETTINGS["journal_max_bytes"], binary_snapshot=False):
+        super().__init__(path, binary_snapshot)
+        self.journal_path = journal_path
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        self._journal = None
+        self._records = 0
+        self._compactor = None
+    def load(self):
+        records = super().load()
+        with self._lock:
+            self._close_journal()
+            self._records = self._replay(records)
+        return records
+    def _journal_entries(self):
+        # (id, book, end offset) per intact record, up to a torn or garbled
+        # line; header lines come through as (None, None, end offset)
+        if not os.path.exists(self.journal_path):
+            return
+        end = 0
+        with open(self.journal_path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    return
+                try:
+                    rec = json.loads(line)
+                    if rec.get("op") == "header":
+                        # Written by SharedJournalBookStorage, carries no book
+                        book_id = book = None
+                    else:
+                        book_id = rec["id"]
+                        book = rec["book"]
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    return
+                end += len(line)
+                yield book_id, book, end
+    def _replay(self, records):
+        if not os.path.exists(self.journal_path):
+            return 0
+        count = 0
+        good_end = 0
+        for book_id, book, good_end in self._journal_entries():
+            if book_id is None:
+                continue
+            if book_id < len(records):
+                records[book_id] = book
+            elif book_id == len(records):
+                records.append(book)
+            count += 1
+        # Drop a torn tail so new records don't get glued onto it
+        if good_end < os.path.getsize(self.journal_path):
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(good_end)
+        return count
+    def iter_records(self):
+        # books.json streamed with the journal's latest state per id laid
+        # over it. The journal is read first: a snapshot rewritten after that
+        # already holds those records, and they are full states, so laying
+        # them over a newer snapshot changes nothing.
+        latest = {book_id: book for book_id, book, _ in self._journal_entries() if book_id is not None}
+        count = 0
+        for record in super().iter_records():
+            yield latest.pop(count, record)
+            count += 1
+        while count in latest:
+            yield latest.pop(count)
+            count += 1
+    def save(self, books):
+        self.wait_for_compaction()
+        with self._lock:
+            super().save(books)
+            self._close_journal()
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            self._records = 0
+    @staticmethod
+    def _journal_lines(books, changed):
+        lines = []
+        for book_id, op in changed:
+            rec = {"op": op, "id": book_id, "book": books[book_id].to_dict()}
+            lines.append(json.dumps(rec, separators=(",", ":")) + "\n")
+        return lines
+    def commit(self, books, changed):
+        lines = self._journal_lines(books, changed)
+        with self._lock:
+            if self._journal is None:
+                self._journal = open(self.journal_path, 'a', encoding="utf-8")
+            self._journal.write("".join(lines))
+            self._journal.flush()
+            self._records += len(lines)
+            size = self._journal.tell()
+        if self._records >= self.max_records or size >= self.max_bytes:
+            self.compact(books)
+    def compact(self, books, background=True):
+        with self._lock:
+            if self._compactor is not None and self._compactor.is_alive():
+                return
+            snapshot = [book.to_dict() for book in books]
+            if self._journal is not None:
+                self._journal.flush()
+            covered = os.path.getsize(self.journal_path) if os.path.exists(self.journal_path) else 0
+            if not background:
+                self._compact(snapshot, covered)
+                return
+            self._compactor = threading.Thread(target=self._compact, args=(snapshot, covered), daemon=True)
+            self._compactor.start()
+    def _compact(self, snapshot, covered):
+        try:
+            self._write_snapshot(snapshot)
+        except OSError:
+            return
+        # Keep only the records appended while the snapshot was being written
+        with self._lock:
+            self._close_journal()
+            tail = b""
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, 'rb') as f:
+                    f.seek(covered)
+                    tail = f.read()
+            tmp = self.journal_path + ".tmp"
+            with open(tmp, 'wb') as f:
+                f.write(tail)
+            os.replace(tmp, self.journal_path)
+            self._records = tail.count(b"\n")
+    def wait_for_compaction(self):
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+    def close(self):
+        self.wait_for_compaction()
+        with self._lock:
+            self._close_journal()
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+class SharedJournalBookStorage(JournalBookStorage):
+    # books.json + books.journal shared by several processes. Library holds
+    # file_lock (books.lock) around every mutation and first applies what
+    # changes() returns, i.e. the records other processes appended since its
+    # last look, so each change is decided on current data and nothing is
+    # overwritten blindly. When the snapshot is rewritten the journal starts
+    # over with a header {"op": "header", "generation": g, "trimmed": n}:
+    # a process that had read up to offset o >= n of the previous generation
+    # continues at the same record in the new file instead of reloading.
+    # The journal is opened per write, never held, so it can be replaced.
+    def __init__(self, path=BOOKS_FILE, journal_path=BOOKS_JOURNAL,
+                 max_records=DEFAULT_SETTINGS["journal_max_records"],
+                 max_bytes=DEFAULT_SETTINGS["journal_max_bytes"]):
+        super().__init__(path, journal_path, max_records, max_bytes)
+        self.file_lock = FileLock(os.path.splitext(path)[0] + ".lock")
+        self._generation = 0
+        self._offset = 0
+        # file_stamp() of the journal when this process last read or wrote it
+        self._stamp = None
+    @staticmethod
+    def _read_header(f):
+        # (generation, trimmed, header length) of an open journal
+        f.seek(0)
+        line = f.readline()
+        try:
+            rec = json.loads(line) if line.endswith(b"\n") else None
+        except ValueError:
+            rec = None
+        if isinstance(rec, dict) and rec.get("op") == "header":
+            return rec["generation"], rec["trimmed"], len(line)
+        return 0, 0, 0
+    def _write_journal(self, generation, trimmed, tail=b""):
+        header = json.dumps({"op": "header", "generation": generation, "trimmed": trimmed}) + "\n"
+        tmp = self.journal_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(header.encode("utf-8"))
+            f.write(tail)
+        os.replace(tmp, self.journal_path)
+        self._generation = generation
+        self._stamp = file_stamp(self.journal_path)
+        return len(header)
+    def load(self):
+        with self.file_lock:
+            records = super().load()
+            with self._lock:
+                self._generation, self._offset, self._stamp = 0, 0, None
+                if os.path.exists(self.journal_path):
+                    with open(self.journal_path, "rb") as f:
+                        self._generation = self._read_header(f)[0]
+                        self._stamp = file_stamp(f.fileno())
+                        self._offset = self._stamp[0]
+            return records
+    def has_changes(self):
+        # Cheap pre-check for polling, without the lock. Size and mtime: a
+        # journal rewritten by another process can end at the same size.
+        try:
+            return file_stamp(self.journal_path) != self._stamp
+        except OSError:
+            return self._offset != 0
+    def changes(self):
+        # [(id, record)] appended by other processes since the last call, or
+        # None if the snapshot was rewritten in a way that needs a reload
+        with self.file_lock, self._lock:
+            try:
+                f = open(self.journal_path, "rb")
+            except FileNotFoundError:
+                return [] if self._offset == 0 else None
+            with f:
+                # Stamped before reading: anything appended after this
+                # shows up in the next has_changes()
+                stamp = file_stamp(f.fileno())
+                generation, trimmed, header_len = self._read_header(f)
+                offset = self._offset
+                if generation != self._generation:
+                    if generation != self._generation + 1 or offset < trimmed:
+                        return None
+                    offset = header_len + offset - trimmed
+                    self._generation = generation
+                f.seek(offset)
+                data = f.read()
+            end = data.rfind(b"\n") + 1
+            found = []
+            for line in data[:end].splitlines():
+                try:
+                    rec = json.loads(line)
+                    if rec.get("op") != "header":
+                        found.append((rec["id"], rec["book"]))
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    # Garbled line: reload (which drops it) rather than
+                    # failing on it at every poll
+                    return None
+            self._offset = offset + end
+            self._stamp = stamp
+            self._records += len(found)
+            return found
+    def commit(self, books, changed):
+        lines = self._journal_lines(books, changed)
+        with self.file_lock, self._lock:
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write("".join(lines))
+                f.flush()
+                self._stamp = file_stamp(f.fileno())
+                self._offset = self._stamp[0]
+            self._records += len(lines)
+            if self._records >= self.max_records or self._offset >= self.max_bytes:
+                self.compact(books)
+    def compact(self, books, background=True):
+        # Caller holds file_lock and has applied changes(), so `books` is
+        # the state of the journal up to self._offset
+        with self.file_lock, self._lock:
+            if self._compactor is not None and self._compactor.is_alive():
+                return
+            args = ([book.to_dict() for book in books], self._offset, self._generation)
+            if not background:
+                self._compact(*args)
+                return
+            self._compactor = threading.Thread(target=self._compact, args=args, daemon=True)
+            self._compactor.start()
+    def _compact(self, snapshot, covered, generation):
+        # The snapshot is dumped without file_lock, so other desks (and this
+        # process's Tk thread) keep working meanwhile; the lock is only held
+        # to check nobody rewrote it since, swap it in and trim the journal
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            self._dump_snapshot(snapshot, tmp)
+        except OSError:
+            return
+        with self.file_lock, self._lock:
+            try:
+                with open(self.journal_path, "rb") as f:
+                    if self._read_header(f)[0] != generation:
+                        os.remove(tmp)
+                        return
+                    f.seek(covered)
+                    tail = f.read()
+                self._replace_snapshot(tmp)
+            except OSError:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                return
+            header_len = self._write_journal(generation + 1, covered, tail)
+            self._offset = header_len + self._offset - covered
+            self._records = tail.count(b"\n")
+    def save(self, books):
+        # No waiting for a compactor here: it needs file_lock, which the
+        # caller may hold, and the generation bump makes it stand down
+        with self.file_lock, self._lock:
+            JsonBookStorage.save(self, books)
+            generation, trimmed = 0, 0
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, "rb") as f:
+                    generation = self._read_header(f)[0]
+                    trimmed = os.fstat(f.fileno()).st_size
+            self._offset = self._write_journal(generation + 1, trimmed)
+            self._records = 0
+class SqliteBookStorage:
+    # One row per copy; id is the book's position in Library.books, so a
+    # mutation is a single-row upsert instead of a whole-file rewrite
+    def __init__(self, path=DATABASE_FILE):
+        self.path = path
+        self._conn = open_database(path)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS books ("
+                "id INTEGER PRIMARY KEY, title TEXT NOT NULL, author TEXT NOT NULL, "
+                "available INTEGER NOT NULL, borrowed_by TEXT, checked_out_at REAL, due_at REAL)"
+            )
+            # Databases created before loans had due dates
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(books)")}
+            for column in ("checked_out_at", "due_at"):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE books ADD COLUMN {column} REAL")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS books_title ON books (title)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS books_author ON books (author)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS books_borrowed_by ON books (borrowed_by)")
+    def is_empty(self):
+        return self._conn.execute("SELECT 1 FROM books LIMIT 1").fetchone() is None
+    COLUMNS = ("title", "author", "available", "borrowed_by", "checked_out_at", "due_at")
+    def load(self):
+        return list(self.iter_records())
+    @staticmethod
+    def _row(book_id, book):
+        return (book_id, book.title, book.author, int(bool(book.available)), book.borrowed_by,
+                book.checked_out_at, book.due_at)
+    def save(self, books):
+        with self._conn:
+            self._conn.execute("DELETE FROM books")
+            self._conn.executemany(
+                "INSERT INTO books (id, title, author, available, borrowed_by, checked_out_at, due_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self._row(i, book) for i, book in enumerate(books)),
+            )
+    def commit(self, books, changed):
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO books (id, title, author, available, borrowed_by, checked_out_at, due_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self._row(book_id, books[book_id]) for book_id, _ in changed),
+            )
+    def iter_records(self):
+        # Streams rows straight from the database cursor
+        rows = self._conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM books ORDER BY id")
+        for row in rows:
+            record = dict(zip(self.COLUMNS, row))
+            record["available"] = bool(record["available"])
+            yield record
+    def close(self):
+        self._conn.close()
+def migrate_json_to_sqlite(db_path=DATABASE_FILE, books_path=BOOKS_FILE,
+                           journal_path=BOOKS_JOURNAL, users_path=USERS_FILE):
+    # One-shot import of books.json (+ any journal) and logins.json. Tables
+    # that already hold data are left alone, so running it twice is harmless.
+    books = SqliteBookStorage(db_path)
+    users = SqliteUserStore(db_path)
+    moved = {"books": 0, "users": 0}
+    try:
+        if books.is_empty():
+            records = JournalBookStorage(books_path, journal_path).load()
+            books.save([Book(**record) for record in records])
+            moved["books"] = len(records)
+        if len(users) == 0:
+            for record in load_users(users_path):
+                moved["users"] += users.add(record)
+    finally:
+        books.close()
+        users.close()
+    write_log(f"Migrated {moved['books']} books and {moved['users']} users from JSON to {db_path}")
+    return moved
+def make_book_storage(settings):
+    if settings.get("storage") == "shared":
+        return SharedJournalBookStorage(
+            BOOKS_FILE, BOOKS_JOURNAL,
+            max_records=settings["journal_max_records"],
+            max_bytes=settings["journal_max_bytes"],
+        )
+    if settings.get("storage") == "sqlite":
+        if not os.path.exists(DATABASE_FILE):
+            migrate_json_to_sqlite()
+        return SqliteBookStorage(DATABASE_FILE)
+    if settings.get("storage") == "journal":
+        return JournalBookStorage(
+            BOOKS_FILE, BOOKS_JOURNAL,
+            max_records=settings["journal_max_records"],
+            max_bytes=settings["journal_max_bytes"],
+            binary_snapshot=settings["binary_snapshot"],
+        )
+    return JsonBookStorage(BOOKS_FILE, binary_snapshot=settings["binary_snapshot"])
 # -----------------------------
 # Library Class
 # -----------------------------
+def shared_mutation(method):
+    # Library mutators run inside Library.exclusive()
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.exclusive():
+            return method(self, *args, **kwargs)
+    return locked
 class Library:
-    def __init__(self):
-        self.books = []
+    def __init__(self, storage=None, compact=False, near_duplicates=False,
+                 loan_days=DEFAULT_SETTINGS["loan_days"], clock=time.time):
+        self.compact = compact
+        self.near_duplicates = near_duplicates
+        self.loan_period = loan_days * 24 * 3600
+        # Wall-clock source for loan timestamps; tests can pass a fake one
+        self.clock = clock
+        self.books = ColumnarBooks() if compact else []
+        self.storage = storage or JsonBookStorage()
+        # Set when other processes write the same storage (see exclusive)
+        self._file_lock = getattr(self.storage, "file_lock", None)
+        self._txn = None
+        # Held by writers and index builds; readers on other threads use
+        # query() instead of taking it
+        self.lock = threading.RLock()
+        self._loans_lock = threading.Lock()
+        self._dup_lock = threading.Lock()
+        self._indexed = True
+        # Bumped when the outermost _begin_change() starts and when its
+        # _end_change() finishes: odd while the indexes are being changed
+        # (see query)
+        self.catalog_version = 0
+        self._changing = 0
+        self._reset_indexes()
+    @metrics.timer("library.load_books")
     def load_books(self):
-        if os.path.exists(BOOKS_FILE):
-            with open(BOOKS_FILE, 'r', encoding="utf-8") as f:
-                data = json.load(f)
-                self.books = [Book(**book) for book in data]
+        with self.lock:
+            records = self.storage.load()
+            self._begin_change()
+            try:
+                self._reset_indexes()
+                if isinstance(records, SnapshotBooks) and not self.compact:
+                    # Books decode on access; indexes are built on first use
+                    self.books = records
+                    self._indexed = False
+                    return
+                if self.compact:
+                    self.books = ColumnarBooks()
+                    for record in records:
+                        self.books.append(Book(**record) if isinstance(record, dict) else record)
+                else:
+                    self.books = [Book(**book) for book in records]
+                self._build_indexes()
+            finally:
+                self._end_change()
+    def _build_indexes(self):
+        # A lazily loaded snapshot fills the loan heap from its loan table
+        # first; the overdue timer may be using that heap on the Tk thread
+        # while this runs on a worker, so the build leaves it alone
+        if isinstance(self.books, SnapshotBooks):
+            self._ensure_loans()
+        schedule = not self._loans_loaded
+        self._begin_change()
+        try:
+            for i, book in enumerate(self.books):
+                book.book_id = i
+                self._index(book, schedule)
+        finally:
+            self._end_change()
+        self._loans_loaded = True
+        self._indexed = True
+    def _ensure_indexes(self):
+        if not self._indexed:
+            with self.lock:
+                if not self._indexed:
+                    self._build_indexes()
+    def prepare(self):
+        # Builds lazily loaded indexes and the duplicate indexes; meant for
+        # a worker thread, so neither the first search nor the first
+        # duplicate check pays for them on the Tk thread
+        self._ensure_indexes()
+        self._duplicate_index()
+    def _ensure_loans(self):
+        # The overdue timer only needs the due-date heap, which a lazily
+        # loaded snapshot provides from its loan table; building every index
+        # here would put the whole cost back on the first screen
+        if self._loans_loaded:
+            return
+        with self._loans_lock:
+            if self._loans_loaded:
+                return
+            books = self.books
+            if isinstance(books, SnapshotBooks):
+                due = books.due_dates()
+            else:
+                due = ((book.book_id, book.due_at) for book in books
+                       if book.borrowed_by is not None and book.due_at is not None)
+            for book_id, due_at in due:
+                self.loans.schedule(book_id, due_at)
+            self._loans_loaded = True
+    def query(self, fn, attempts=3):
+        # Runs a read-only fn off the Tk thread without blocking writers:
+        # the result counts if catalog_version was even and unchanged
+        # around it, else fn runs again; the last attempt holds the lock.
+        # Returns (result, catalog_version).
+        self._ensure_indexes()
+        for _ in range(attempts - 1):
+            version = self.catalog_version
+            if version % 2:
+                time.sleep(0.001)
+                continue
+            try:
+                result = fn()
+            except Exception:
+                # Indexes changed mid-read; anything real shows up below
+                continue
+            if self.catalog_version == version:
+                return result, version
+        with self.lock:
+            return fn(), self.catalog_version
+    @metrics.timer("library.save_books")
+    @shared_mutation
     def save_books(self):
-        with open(BOOKS_FILE, 'w', encoding="utf-8") as f:
-            json.dump([book.to_dict() for book in self.books], f, indent=4)
-    def add_book(self, book, actor=None):
+        self.storage.save(self.books)
+    # -------- Other processes ----------
+    @property
+    def shared(self):
+        return self._file_lock is not None
+    @contextmanager
+    def exclusive(self):
+        # Holds `lock`. Shared storage: also hold its file lock and first
+        # apply what other processes wrote, so checks like "is this copy on
+        # the shelf" see current data and the commit cannot be based on a
+        # stale state
+        with self.lock:
+            lock = self._file_lock
+            if lock is None:
+                yield self
+                return
+            with lock:
+                if lock.depth == 1:
+                    self._apply_changes()
+                yield self
+    def sync(self):
+        # Polled by the UI; True if another process changed the catalog
+        if self._file_lock is None or not self.storage.has_changes():
+            return False
+        with self.lock, self._file_lock:
+            return self._apply_changes()
+    def _apply_changes(self):
+        changes = self.storage.changes()
+        if changes is None:
+            self.load_books()
+            return True
+        self._begin_change()
+        try:
+            return self._apply_records(changes)
+        finally:
+            self._end_change()
+    def _apply_records(self, changes):
+        for book_id, record in changes:
+            if book_id > len(self.books):
+                self.load_books()
+                return True
+            book = Book(**record)
+            if book_id == len(self.books):
+                book.book_id = book_id
+                self.books.append(book)
+                self._index(book)
+                continue
+            current = self.books[book_id]
+            renamed = (current.title, current.author) != (book.title, book.author)
+            if renamed:
+                self._unindex(current)
+            else:
+                self._unindex_loan(current)
+            for key, value in book.to_dict().items():
+                setattr(current, key, value)
+            if renamed:
+                self._index(current)
+            else:
+                self._index_loan(current)
+        return bool(changes)
+    # -------- Indexes ----------
+    # title -> author -> TitleRecord (copies + pool of available copies),
+    # borrower -> title -> ids of held copies, the ids of every available copy and the
+    # due-date heap of open loans. Kept in step with each mutation.
+    def _begin_change(self):
+        # Brackets nest; only the outermost pair moves catalog_version, so
+        # it stays odd through a whole reload, build or rollback
+        if not self._changing:
+            self.catalog_version += 1
+        self._changing += 1
+    def _end_change(self):
+        self._changing -= 1
+        if not self._changing:
+            self.catalog_version += 1
+    def _reset_indexes(self):
+        self.catalog_version += 2
+        self._titles = {}
+        self._by_borrower = {}
+        self._available = set()
+        self.loans = LoanScheduler()
+        # Set when a lazily loaded snapshot filled `loans` ahead of the rest
+        self._loans_loaded = False
+        self._search = SearchIndex()
+        # duplicate key -> copy ids, and the MinHash index; both built on
+        # first use and then kept up to date like the others
+        self._dup_keys = None
+        self._near = None
+    def _index(self, book, schedule=True):
+        self._begin_change()
+        try:
+            authors = self._titles.get(book.title)
+            if authors is None:
+                authors = self._titles[book.title] = {}
+            record = authors.get(book.author)
+            if record is None:
+                record = authors[book.author] = TitleRecord(book.title, book.author)
+            record.copies.append(book.book_id)
+            self._search.add(book.book_id, book.title, book.author)
+            if self._dup_keys is not None:
+                key = duplicate_key(book.title, book.author)
+                self._dup_keys.setdefault(key, []).append(book.book_id)
+                if self._near is not None:
+                    self._near.add(book.book_id, key)
+            self._index_loan(book, schedule)
+        finally:
+            self._end_change()
+    def _unindex(self, book):
+        self._begin_change()
+        try:
+            self._unindex_loan(book)
+            authors = self._titles.get(book.title)
+            record = authors and authors.get(book.author)
+            if record and book.book_id in record.copies:
+                record.copies.remove(book.book_id)
+                if not record.copies:
+                    del authors[book.author]
+                    if not authors:
+                        del self._titles[book.title]
+            self._search.remove(book.book_id)
+            if self._dup_keys is not None:
+                key = duplicate_key(book.title, book.author)
+                copies = self._dup_keys.get(key)
+                if copies and book.book_id in copies:
+                    copies.remove(book.book_id)
+                    if not copies:
+                        del self._dup_keys[key]
+                if self._near is not None:
+                    self._near.remove(book.book_id)
+        finally:
+            self._end_change()
+    def _index_loan(self, book, schedule=True):
+        if book.available:
+            self._available.add(book.book_id)
+            self._titles[book.title][book.author].available.add(book.book_id)
+        if book.borrowed_by is not None:
+            held = self._by_borrower.setdefault(book.borrowed_by, {})
+            held.setdefault(book.title, set()).add(book.book_id)
+            if schedule and book.due_at is not None:
+                self.loans.schedule(book.book_id, book.due_at)
+    def _unindex_loan(self, book):
+        self._available.discard(book.book_id)
+        self.loans.cancel(book.book_id)
+        authors = self._titles.get(book.title)
+        record = authors and authors.get(book.author)
+        if record:
+            record.available.discard(book.book_id)
+        held = self._by_borrower.get(book.borrowed_by)
+        if held is not None:
+            copies = held.get(book.title)
+            if copies is not None:
+                copies.discard(book.book_id)
+                if not copies:
+                    del held[book.title]
+            if not held:
+                del self._by_borrower[book.borrowed_by]
+    def _set_loan(self, book, borrower_id):
+        self._touch(book)
+        self._unindex_loan(book)
+        book.available = borrower_id is None
+        book.borrowed_by = borrower_id
+        book.checked_out_at = None if borrower_id is None else self.clock()
+        book.due_at = None if borrower_id is None else book.checked_out_at + self.loan_period
+        self._index_loan(book)
+        self._commit((book.book_id, "update"))
+    def _duplicate_index(self):
+        # Normally built by prepare() on the search worker. The build runs
+        # through query(), so edits are not held up meanwhile, and the
+        # result is swapped in under the lock only if none happened.
+        if self._dup_keys is None or (self.near_duplicates and self._near is None):
+            with self._dup_lock:
+                if self._dup_keys is None or (self.near_duplicates and self._near is None):
+                    indexes, version = self.query(self._build_duplicates)
+                    with self.lock:
+                        if self.catalog_version != version:
+                            indexes = self._build_duplicates()
+                        self._dup_keys, self._near = indexes
+        return self._dup_keys
+    def _build_duplicates(self):
+        dup_keys = self._dup_keys
+        if dup_keys is None:
+            dup_keys = {}
+            for book in self.books:
+                dup_keys.setdefault(duplicate_key(book.title, book.author), []).append(book.book_id)
+        near = self._near
+        if self.near_duplicates and near is None:
+            near = NearDuplicateIndex()
+            for key, ids in dup_keys.items():
+                for book_id in ids:
+                    near.add(book_id, key)
+        return dup_keys, near
+    def find_duplicates(self, title, author):
+        key = duplicate_key(title, author)
+        ids = list(self._duplicate_index().get(key, ()))
+        if self._near is not None:
+            ids = sorted(set(ids).union(self._near.find(key)))
+        return [self.books[i] for i in ids]
+    def is_duplicate(self, title, author):
+        key = duplicate_key(title, author)
+        if key in self._duplicate_index():
+            return True
+        return self._near is not None and bool(self._near.find(key))
+    def books_borrowed_by(self, borrower_id):
+        self._ensure_indexes()
+        held = self._by_borrower.get(borrower_id, {})
+        return [self.books[i] for i in sorted(i for ids in held.values() for i in ids)]
+    def title_record(self, title, author=None):
+        # Without author: the first book with that title
+        return next(iter(self._title_pools(title, author)), None)
+    def _title_pools(self, title, author=None):
+        self._ensure_indexes()
+        authors = self._titles.get(title)
+        if not authors:
+            return []
+        if author is None:
+            return list(authors.values())
+        return [authors[author]] if author in authors else []
+    def title_records(self, books=None):
+        # One record per title + author, in catalog order or the order of `books`
+        self._ensure_indexes()
+        if books is None:
+            return [record for authors in self._titles.values() for record in authors.values()]
+        seen = {}
+        for book in books:
+            key = (book.title, book.author)
+            if key not in seen:
+                seen[key] = self._titles[book.title][book.author]
+        return list(seen.values())
+    def available_books(self):
+        self._ensure_indexes()
+        return [self.books[i] for i in sorted(self._available)]
+    def next_due(self):
+        # (due_at, book) of the next loan to fall due, or None
+        self._ensure_loans()
+        upcoming = self.loans.next_due()
+        return None if upcoming is None else (upcoming[0], self.books[upcoming[1]])
+    def pop_overdue(self, now=None):
+        # Loans that fell due since the previous call, oldest first
+        self._ensure_loans()
+        now = self.clock() if now is None else now
+        return [self.books[i] for i in self.loans.pop_due(now)]
+    def overdue_loans(self, now=None):
+        self.pop_overdue(now)
+        overdue = self.loans.overdue
+        return [self.books[i] for i in sorted(overdue, key=overdue.get)]
+    @contextmanager
+    def transaction(self):
+        # Mutations inside the block are applied in memory and persisted with
+        # one storage commit and one log write when it exits; an exception
+        # restores every touched book and drops the added ones.
+        if self._txn is not None:
+            yield self
+            return
+        with self.exclusive():
+            self._ensure_indexes()
+            txn = self._txn = {"start": len(self.books), "changed": {}, "before": {}, "logs": []}
+            try:
+                yield self
+                self._txn = None
+                if txn["changed"]:
+                    with metrics.timed("storage.commit"):
+                        self.storage.commit(self.books, sorted(txn["changed"].items()))
+            except BaseException:
+                self._txn = None
+                self._rollback(txn)
+                raise
+        write_logs(txn["logs"])
+    def _rollback(self, txn):
+        self._begin_change()
+        try:
+            for book in reversed(self.books[txn["start"]:]):
+                self._unindex(book)
+            del self.books[txn["start"]:]
+            for book_id, state in txn["before"].items():
+                book = self.books[book_id]
+                self._unindex_loan(book)
+                for key, value in state.items():
+                    setattr(book, key, value)
+                self._index_loan(book)
+        finally:
+            self._end_change()
+    def _touch(self, book):
+        # Remember a book's state before its first change in a transaction
+        txn = self._txn
+        if txn is not None and book.book_id < txn["start"] and book.book_id not in txn["before"]:
+            txn["before"][book.book_id] = book.to_dict()
+    def _commit(self, *changed):
+        if self._txn is None:
+            with metrics.timed("storage.commit"):
+                self.storage.commit(self.books, changed)
+            return
+        pending = self._txn["changed"]
+        for book_id, op in changed:
+            if pending.get(book_id) != "add":
+                pending[book_id] = op
+    def log(self, message):
+        # Inside a transaction the line is written when it commits
+        if self._txn is None:
+            write_log(message)
+        else:
+            self._txn["logs"].append(message)
+    def add_books(self, books, actor=None, skip_duplicates=False):
+        with self.transaction():
+            return sum(self.add_book(book, actor=actor, skip_duplicates=skip_duplicates) for book in books)
+    def checkout_many(self, titles, borrower_id, actor=None):
+        with self.transaction():
+            return [self.checkout_book(title, borrower_id, actor=actor) for title in titles]
+    def return_many(self, titles, borrower_id, actor=None):
+        with self.transaction():
+            return [self.return_book(title, borrower_id, actor=actor) for title in titles]
+    @metrics.timer("library.add_book")
+    @shared_mutation
+    def add_book(self, book, actor=None, skip_duplicates=False):
+        self._ensure_indexes()
+        if skip_duplicates and self.is_duplicate(book.title, book.author):
+            return False
+        book.book_id = len(self.books)
         self.books.append(book)
-        self.save_books()
+        self._index(book)
+        self._commit((book.book_id, "add"))
         if actor:
-            write_log(f"{actor} added book '{book.title}' by {book.author}")
-    def checkout_book(self, title, borrower_id, actor=None):
-        for book in self.books:
-            if book.title == title and book.available:
-                book.available = False
-                book.borrowed_by = borrower_id
-                self.save_books()
-                if actor:
-                    write_log(f"{actor} checked out '{title}' to borrower '{borrower_id}'")
-                return True
-        return False
-    def return_book(self, title, borrower_id, actor=None):
-        for book in self.books:
-            if book.title == title and not book.available and book.borrowed_by == borrower_id:
-                book.available = True
-                book.borrowed_by = None
-                self.save_books()
-                if actor:
-                    write_log(f"{actor} returned '{title}' from borrower '{borrower_id}'")
-                return True
+            self.log(f"{actor} added book '{book.title}' by {book.author}")
+        return True
+    @metrics.timer("library.checkout_copy")
+    @shared_mutation
+    def checkout_copy(self, book_id, borrower_id, actor=None):
+        self._ensure_indexes()
+        if book_id not in self._available:
+            return False
+        book = self.books[book_id]
+        self._set_loan(book, borrower_id)
+        if actor:
+            self.log(f"{actor} checked out '{book.title}' to borrower '{borrower_id}'")
+        return True
+    @metrics.timer("library.return_copy")
+    @shared_mutation
+    def return_copy(self, book_id, borrower_id, actor=None):
+        self._ensure_indexes()
+        book = self.books[book_id]
+        if book_id not in self._by_borrower.get(borrower_id, {}).get(book.title, ()):
+            return False
+        if book.available:
+            return False
+        self._set_loan(book, None)
+        if actor:
+            self.log(f"{actor} returned '{book.title}' from borrower '{borrower_id}'")
+        return True
+    @metrics.timer("library.checkout_book")
+    @shared_mutation
+    def checkout_book(self, title, borrower_id, actor=None, author=None):
+        # Any copy on the shelf will do: take one from the title's pool (of
+        # that author's book when given, else of any book with the title)
+        for record in self._title_pools(title, author):
+            if record.available:
+                return self.checkout_copy(record.available.pop(), borrower_id, actor=actor)
         return False
-    def filter_books(self, keyword):
-        keyword = keyword.lower()
-        return [book for book in self.books if keyword in book.title.lower() or keyword in book.author.lower()]
+    @metrics.timer("library.return_book")
+    @shared_mutation
+    def return_book(self, title, borrower_id, actor=None, author=None):
+        self._ensure_indexes()
+        held = self._by_borrower.get(borrower_id, {}).get(title)
+        if held and author is not None:
+            held = [i for i in held if self.books[i].author == author]
+        if not held:
+            return False
+        return self.return_copy(next(iter(held)), borrower_id, actor=actor)
+    @metrics.timer("library.filter_books")
+    def filter_books(self, keyword, within=None):
+        # Same matches as a case-insensitive substring test on title/author,
+        # best matches first (title before author, word starts before infixes).
+        # `within`: ids of an earlier result for a substring of keyword, only
+        # valid while catalog_version is unchanged.
+        if not keyword:
+            return list(self.books)
+        self._ensure_indexes()
+        return [self.books[i] for i in self._search.search(keyword, within)]
+    def first_matches(self, keyword, limit, within=None):
+        # Up to `limit` of filter_books' matches, found without a full search
+        if not keyword:
+            return list(self.books[:limit])
+        self._ensure_indexes()
+        return [self.books[i] for i in self._search.first(keyword, limit, within)]
+# -----------------------------
+# Bulk import/export
+# -----------------------------
+CATALOG_FIELDS = ["title", "author", "available", "borrowed_by", "checked_out_at", "due_at"]
+def catalog_format(path, fmt=None):
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower()
+    if fmt == "ndjson":
+        fmt = "jsonl"
+    if fmt not in ("csv", "jsonl"):
+        raise ValueError(f"unknown catalog format {fmt!r} (expected csv or jsonl)")
+    return fmt
+def read_catalog_rows(path, fmt=None):
+    # Yields (row dict, None) or (None, error) without reading the whole
+    # file; utf-8-sig drops the BOM Excel puts in front of CSV headers
+    fmt = catalog_format(path, fmt)
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if fmt == "csv":
+            for row in csv.DictReader(f):
+                yield row, None
+        else:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield None, f"invalid JSON ({e.msg})"
+                    continue
+                yield (row, None) if isinstance(row, dict) else (None, "not a JSON object")
+def parse_catalog_value(field, value):
+    # Loan columns as written by export_catalog: strings from CSV, typed
+    # values from JSONL; empty means unset
+    if value is None or value == "":
+        return None
+    if field == "borrowed_by":
+        return str(value)
+    if field != "available":
+        return float(value)
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text not in ("true", "false", "1", "0"):
+        raise ValueError(f"available is {value!r}")
+    return text in ("true", "1")
+def validate_rows(rows, stats):
+    for row, error in rows:
+        stats["read"] += 1
+        if error is None:
+            title = str(row.get("title") or "").strip()
+            author = str(row.get("author") or "").strip()
+            if not title or not author:
+                error = "missing title or author"
+            try:
+                copies = int(row.get("copies") or 1)
+            except (TypeError, ValueError):
+                error, copies = "copies is not a number", 1
+            try:
+                loan = {field: parse_catalog_value(field, row.get(field)) for field in CATALOG_FIELDS[2:]}
+            except (TypeError, ValueError) as e:
+                error = f"bad loan column ({e})"
+            else:
+                if loan["borrowed_by"] is not None:
+                    loan["available"] = False
+                    if copies > 1:
+                        error = "a row with a borrower must be a single copy"
+                elif loan["available"] is None:
+                    loan["available"] = True
+        if error is not None:
+            stats["invalid"] += 1
+            if len(stats["errors"]) < 20:
+                stats["errors"].append(f"row {stats['read']}: {error}")
+            continue
+        yield title, author, max(copies, 1), loan
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+def import_catalog(library, path, fmt=None, chunk_size=5000, actor=None, progress=None):
+    # read -> validate -> chunk -> add; each chunk is one transaction, so one
+    # persist and one log line per chunk rather than per book. A "copies"
+    # column adds that many copies; loan columns are kept, so an export
+    # re-imports as it was. Rows matching a book that was in the catalog
+    # before the import are skipped, while repeats within the file (one
+    # row per copy in an export) are further copies.
+    stats = {"read": 0, "invalid": 0, "duplicates": 0, "added": 0, "errors": [], "seconds": 0.0}
+    start = time.perf_counter()
+    rows = validate_rows(read_catalog_rows(path, fmt), stats)
+    imported = set()
+    for chunk in chunked(rows, chunk_size):
+        added = 0
+        with library.transaction():
+            for title, author, copies, loan in chunk:
+                key = duplicate_key(title, author)
+                if key not in imported and library.is_duplicate(title, author):
+                    stats["duplicates"] += 1
+                    continue
+                imported.add(key)
+                library.add_books([Book(title, author, **loan) for _ in range(copies)])
+                added += copies
+            library.log(f"{actor or 'import'} imported {added} books from '{os.path.basename(path)}'")
+        stats["added"] += added
+        stats["seconds"] = time.perf_counter() - start
+        if progress:
+            progress(stats)
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+def export_catalog(records, path, fmt=None, progress=None, every=50000):
+    # records: any iterable of book dicts or Book-likes, written one by one
+    fmt = catalog_format(path, fmt)
+    count = 0
+    start = time.perf_counter()
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=CATALOG_FIELDS) if fmt == "csv" else None
+        if writer:
+            writer.writeheader()
+        for record in records:
+            if not isinstance(record, dict):
+                record = record.to_dict()
+            if writer:
+                writer.writerow(record)
+            else:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+            if progress and count % every == 0:
+                progress(count, time.perf_counter() - start)
+    return count
+def run_cli(argv):
+    parser = argparse.ArgumentParser(prog="catalyst", description="Headless catalog tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    imp = sub.add_parser("import", help="add books from a CSV or JSONL file")
+    imp.add_argument("path")
+    imp.add_argument("--format", choices=["csv", "jsonl"])
+    imp.add_argument("--chunk-size", type=int, default=5000)
+    imp.add_argument("--actor", default="import")
+    exp = sub.add_parser("export", help="write the catalog to a CSV or JSONL file")
+    exp.add_argument("path")
+    exp.add_argument("--format", choices=["csv", "jsonl"])
+    rep = sub.add_parser("report", help="print usage analytics from log.txt")
+    rep.add_argument("--top", type=int, default=10)
+    args = parser.parse_args(argv)
+    settings = load_settings()
+    configure_metrics(settings)
+    if args.command == "report":
+        analytics = LogAnalytics(backups=settings["log_backups"])
+        read = analytics.update()
+        print(analytics.report(args.top))
+        print(f"({read:,} new log lines read)", file=sys.stderr)
+        return 0
+    storage = make_book_storage(settings)
+    try:
+        if args.command == "export":
+            def report(count, seconds):
+                print(f"  {count:,} books ({count / seconds:,.0f}/s)", file=sys.stderr)
+            count = export_catalog(storage.iter_records(), args.path, args.format, progress=report)
+            print(f"Exported {count:,} books to {args.path}")
+            return 0
+        library = Library(storage, compact=settings["compact_catalog"], near_duplicates=settings["near_duplicates"])
+        library.load_books()
+        def report(stats):
+            rate = stats["added"] / stats["seconds"] if stats["seconds"] else 0
+            print(f"  read {stats['read']:,}  added {stats['added']:,}  ({rate:,.0f} books/s)", file=sys.stderr)
+        stats = import_catalog(library, args.path, args.format, args.chunk_size, args.actor, progress=report)
+        print(f"Imported {stats['added']:,} of {stats['read']:,} rows in {stats['seconds']:.1f}s "
+              f"({stats['duplicates']:,} duplicates, {stats['invalid']:,} invalid)")
+        for error in stats["errors"]:
+            print(f"  {error}", file=sys.stderr)
+        return 0
+    finally:
+        storage.close()
+        log_sink.flush()
+# -----------------------------
+# Log analytics
+# -----------------------------
+LOG_LINE = re.compile(r"\[(\d{4}-\d{2}-\d{2}) [\d:]{8}\] (.*)")
+LOG_EVENTS = [
+    ("checkout", re.compile(r"(.*) checked out '(.*)' to borrower '(.*)'")),
+    ("return", re.compile(r"(.*) returned '(.*)' from borrower '(.*)'")),
+    ("add", re.compile(r"(.*) added book '(.*)' by .*")),
+    ("login", re.compile(r"Login success for '(.*)'")),
+    ("login_failed", re.compile(r"Login failed \(.*\) for '(.*)'")),
+]
+class LogAnalytics:
+    # Rolling aggregates over log.txt, kept up to date by reading only what
+    # was appended since the last update(). The checkpoint is the byte offset
+    # reached plus a fingerprint of that file's first bytes, so after LogSink
+    # rotates log.txt the file can be found again among log.txt.1 .. N and
+    # the rest of it read before the newer files. Aggregates and checkpoint
+    # are saved together, so a crash never counts a line twice.
+    def __init__(self, path=LOG_FILE, state_path=ANALYTICS_STATE, backups=DEFAULT_SETTINGS["log_backups"]):
+        self.path = path
+        self.state_path = state_path
+        self.backups = backups
+        self._lock = threading.Lock()
+        self.reset()
+        if os.path.exists(state_path):
+            try:
+                with open(state_path, "r", encoding="utf-8") as f:
+                    state = json.load(f)
+                self.fingerprint = state["fingerprint"]
+                self.offset = state["offset"]
+                self.borrows = state["borrows"]
+                self.active = {day: set(users) for day, users in state["active"].items()}
+                self.failed_logins = state["failed_logins"]
+                self.failed_by_user = state["failed_by_user"]
+                self.lines = state["lines"]
+            except Exception:
+                self.reset()
+    def reset(self):
+        self.fingerprint = None
+        self.offset = 0
+        self.borrows = {}          # title -> checkouts
+        self.active = {}           # day -> usernames that logged in or acted
+        self.failed_logins = {}    # day -> failed attempts
+        self.failed_by_user = {}   # attempted username -> failed attempts
+        self.lines = 0
+    FINGERPRINT_BYTES = 256
+    @staticmethod
+    def _fingerprint(f, length):
+        # "length:crc32" of the first length bytes. Only bytes before the
+        # checkpoint are used, and those never change as the file grows.
+        f.seek(0)
+        head = f.read(length)
+        return f"{len(head)}:{zlib.crc32(head):08x}"
+    def _file_fingerprint(self, path, length):
+        try:
+            with open(path, "rb") as f:
+                return self._fingerprint(f, length)
+        except OSError:
+            return None
+    def _sources(self):
+        # (path, start offset) still to read, oldest first
+        newest_first = [self.path] + [f"{self.path}.{i}" for i in range(1, self.backups + 1)]
+        existing = [path for path in newest_first if os.path.exists(path)]
+        if self.fingerprint is not None:
+            length = int(self.fingerprint.split(":", 1)[0])
+            for i, path in enumerate(existing):
+                if self._file_fingerprint(path, length) == self.fingerprint and os.path.getsize(path) >= self.offset:
+                    return [(path, self.offset)] + [(newer, 0) for newer in reversed(existing[:i])]
+        # First run, or the checkpointed file was rotated out: read what is left
+        return [(path, 0) for path in reversed(existing)]
+    def update(self):
+        with self._lock:
+            before = self.lines
+            for path, start in self._sources():
+                self._consume(path, start)
+            if self.lines != before:
+                self._save()
+            return self.lines - before
+    def _consume(self, path, start):
+        # Reads complete lines from start and moves the checkpoint past them.
+        # The fingerprint comes from the open handle: if LogSink rotates the
+        # file meanwhile, the checkpoint still names the file that was read.
+        try:
+            f = open(path, "rb")
+        except OSError:
+            return
+        with f:
+            f.seek(start)
+            pos = start
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # still being written
+                pos += len(line)
+                self._record(line.decode("utf-8", "replace").rstrip("\r\n"))
+            if pos > 0:
+                self.fingerprint = self._fingerprint(f, min(pos, self.FINGERPRINT_BYTES))
+                self.offset = pos
+    def _record(self, line):
+        self.lines += 1
+        match = LOG_LINE.match(line)
+        if match is None:
+            return
+        day, message = match.groups()
+        for kind, pattern in LOG_EVENTS:
+            event = pattern.fullmatch(message)
+            if event is None:
+                continue
+            if kind == "login_failed":
+                self.failed_logins[day] = self.failed_logins.get(day, 0) + 1
+                self.failed_by_user[event[1]] = self.failed_by_user.get(event[1], 0) + 1
+                return
+            if kind == "checkout":
+                self.borrows[event[2]] = self.borrows.get(event[2], 0) + 1
+            self.active.setdefault(day, set()).add(event[1])
+            return
+    def _save(self):
+        state = {
+            "fingerprint": self.fingerprint,
+            "offset": self.offset,
+            "borrows": self.borrows,
+            "active": {day: sorted(users) for day, users in self.active.items()},
+            "failed_logins": self.failed_logins,
+            "failed_by_user": self.failed_by_user,
+            "lines": self.lines,
+        }
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_path)
+    # -------- Queries ----------
+    def top_borrowed(self, n=10):
+        return heapq.nlargest(n, self.borrows.items(), key=lambda item: item[1])
+    def active_users(self, days=7):
+        # (day, distinct users) for the most recent `days` days with activity
+        return [(day, len(self.active[day])) for day in sorted(self.active)[-days:]]
+    def failed_login_counts(self, days=7):
+        return [(day, self.failed_logins[day]) for day in sorted(self.failed_logins)[-days:]]
+    def top_failed_users(self, n=5):
+        return heapq.nlargest(n, self.failed_by_user.items(), key=lambda item: item[1])
+    def report(self, n=10):
+        lines = ["Most borrowed titles:"]
+        lines += [f"  {count:>6}  {title}" for title, count in self.top_borrowed(n)] or ["  (none yet)"]
+        lines.append("Active users per day:")
+        lines += [f"  {day}  {count}" for day, count in self.active_users()] or ["  (none yet)"]
+        lines.append("Failed logins per day:")
+        lines += [f"  {day}  {count}" for day, count in self.failed_login_counts()] or ["  (none yet)"]
+        if self.failed_by_user:
+            lines.append("Most failed usernames:")
+            lines += [f"  {count:>6}  {user}" for user, count in self.top_failed_users()]
+        return "\n".join(lines)
+# -----------------------------
+# AI recommendations
+# -----------------------------
+GEMINI_MODEL = "gemini-1.5-pro"
+# Bump when the prompt or parsing changes so cached answers are not reused
+PROMPT_VERSION = 1
+def build_genre_prompt(genre):
+    return f"""
+    You are a helpful assistant that recommends books for a library system.
+    Given a genre, return a JSON object with an array of books, each with 'title' and 'author'.
+    Do not include any extra commentary or explanation, only valid JSON.
+    Genre: {genre}
+    Return format:
+    {{
+    "books": [
+        {{"title": "Title 1", "author": "Author 1"}},
+        {{"title": "Title 2", "author": "Author 2"}}
+    ]
+    }}
+    """
+def parse_recommendations(raw_text):
+    # Parse JSON (with a small salvage if the model adds text around it)
+    try:
+        data = json.loads(raw_text)
+    except json.JSONDecodeError:
+        start, end = raw_text.find("{"), raw_text.rfind("}")
+        if start != -1 and end != -1 and end > start:
+            data = json.loads(raw_text[start:end+1])
+        else:
+            raise
+    books = []
+    for item in data.get("books", []):
+        title = (item.get("title") or "").strip()
+        author = (item.get("author") or "").strip()
+        if title and author:
+            books.append((title, author))
+    return books
+def fetch_recommendations(model, genre):
+    # Runs on a worker thread: no Tk calls in here
+    with metrics.timed("ai.generate_content"):
+        response = model.generate_content(build_genre_prompt(genre))
+    return parse_recommendations((response.text or "").strip())
+class FakeGenerativeModel:
+    # Offline stand-in for genai.GenerativeModel with a simulated round trip
+    BOOKS = [
+        {"title": "The Time Machine", "author": "H. G. Wells"},
+        {"title": "Twenty Thousand Leagues Under the Seas", "author": "Jules Verne"},
+        {"title": "The Left Hand of Darkness", "author": "Ursula K. Le Guin"},
+        {"title": "Kindred", "author": "Octavia E. Butler"},
+    ]
+    def __init__(self, latency=1.5, books=None):
+        self.latency = latency
+        self.books = books if books is not None else self.BOOKS
+    def generate_content(self, prompt):
+        time.sleep(self.latency)
+        return SimpleNamespace(text=json.dumps({"books": self.books}))
+class RecommendationCache:
+    # Parsed recommendations per (genre, prompt version, model) on disk.
+    # Entries expire after ttl seconds; past max_entries the least recently
+    # used one is evicted. Entries hold the raw suggestions, so filtering out
+    # books the library already owns happens when they are read.
+    def __init__(self, path=RECOMMENDATIONS_CACHE, ttl=DEFAULT_SETTINGS["ai_cache_ttl"],
+                 max_entries=DEFAULT_SETTINGS["ai_cache_entries"], clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        self._entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if isinstance(data, dict):
+                    self._entries = data
+            except Exception:
+                pass
+    @staticmethod
+    def key(genre, model_name, prompt_version=PROMPT_VERSION):
+        return f"{genre}|v{prompt_version}|{model_name}"
+    @staticmethod
+    def _parse(entry):
+        # (stored, books), or None for a hand-edited or truncated entry
+        try:
+            return float(entry["stored"]), [(title, author) for title, author in entry["books"]]
+        except (TypeError, KeyError, ValueError):
+            return None
+    def get(self, key):
+        entry = self._entries.pop(key, None)
+        parsed = self._parse(entry)
+        if parsed is None or self.clock() - parsed[0] > self.ttl:
+            # Expired and malformed entries are dropped
+            self.misses += 1
+            metrics.incr("ai.cache_miss")
+            if entry is not None:
+                self._dirty = True
+            return None
+        # Dicts keep insertion order: re-inserting marks it most recently used
+        self._entries[key] = entry
+        self._dirty = True
+        self.hits += 1
+        metrics.incr("ai.cache_hit")
+        return parsed[1]
+    def put(self, key, books):
+        self._entries.pop(key, None)
+        self._entries[key] = {"stored": self.clock(), "books": [list(book) for book in books]}
+        while len(self._entries) > self.max_entries:
+            del self._entries[next(iter(self._entries))]
+        self._dirty = True
+        self.flush()
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+        }
+    def flush(self):
+        if not self._dirty:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp, self.path)
+        self._dirty = False
 # -----------------------------
 # App and Frames
 # -----------------------------
 class App(ctk.CTk, tk.Tk):
     def __init__(self):
         super().__init__()
-        # --- Gemini setup ---
-        
-        api_key = os.getenv("GOOGLE_API_KEY") or self.load_api_key("api_key.txt")
-        if not api_key:
-            messagebox.showerror("Configuration error", "GOOGLE_API_KEY not set in environment.")
-        genai.configure(api_key=api_key)  # ← add this
-
-        generation_config = {
-            "temperature": 0.5,
-            "top_p": 1,
-            "top_k": 1,
-            "max_output_tokens": 512,
-        }
-        safety_settings = [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-        ]
-        self.model = genai.GenerativeModel(
-            model_name="gemini-1.5-pro",
-            generation_config=generation_config,
-            safety_settings=safety_settings
+        self.settings = load_settings()
+        configure_metrics(self.settings)
+        log_sink.max_bytes = self.settings["log_max_bytes"]
+        log_sink.backups = self.settings["log_backups"]
+        # --- Gemini setup (created on first use, see get_model) ---
+        self._model = None
+        self._model_lock = threading.Lock()
+        self.model_name = "fake" if self.settings["ai_backend"] == "fake" else GEMINI_MODEL
+        self.ai_worker = TkWorker(self, max_workers=None, name="ai")
+        # --- Password hashing runs off the Tk thread ---
+        self.auth_worker = TkWorker(self, max_workers=2, name="auth")
+        self.bcrypt_rounds = self.settings["bcrypt_rounds"]
+        # --- Usage reports, rebuilt incrementally from log.txt ---
+        self.analytics = LogAnalytics(backups=self.settings["log_backups"])
+        self.report_worker = TkWorker(self, max_workers=1, name="report")
+        # --- Live search queries run here, newest wins; two threads, so
+        # a long Library.prepare() does not hold searches up ---
+        self.search_worker = TkWorker(self, max_workers=2, name="search")
+        self.ai_cache = RecommendationCache(
+            ttl=self.settings["ai_cache_ttl"], max_entries=self.settings["ai_cache_entries"]
         )
-
         ctk.set_appearance_mode("dark")
         ctk.set_default_color_theme("dark-blue")
         self.title("Book Manager")
@@ -181,7 +2864,13 @@ class App(ctk.CTk, tk.Tk):
         # State: current user (plaintext username)
         self.current_user = None
         # Library instance (shared)
-        self.library = Library()
+        self.library = Library(
+            make_book_storage(self.settings),
+            compact=self.settings["compact_catalog"],
+            near_duplicates=self.settings["near_duplicates"],
+            loan_days=self.settings["loan_days"],
+        )
+        use_user_store(make_user_store(self.settings))
         self.library.load_books()
         # Create frames
         self.frames = {}
@@ -190,6 +2879,24 @@ class App(ctk.CTk, tk.Tk):
             self.frames[F] = frame
             frame.grid(row=0, column=0, sticky="nsew")
         self.show_frame(LoginFrame)
+        self.watchdog = None
+        self.after_idle(self._on_first_frame)
+    def _on_first_frame(self):
+        record_startup_time(time.perf_counter() - STARTUP_CLOCK)
+        target_ms = self.settings["bcrypt_target_ms"]
+        if target_ms:
+            self.auth_worker.submit(
+                "calibrate", calibrate_bcrypt_rounds, target_ms / 1000,
+                on_done=lambda rounds: setattr(self, "bcrypt_rounds", rounds),
+            )
+        if self.settings["ai_warmup"]:
+            threading.Thread(target=self._warm_model, name="ai-warmup", daemon=True).start()
+        if self.settings["stall_threshold_ms"]:
+            self.watchdog = StallWatchdog(
+                self, threshold=self.settings["stall_threshold_ms"] / 1000,
+                keep=self.settings["stall_report_entries"],
+            )
+            self.watchdog.start()
     def show_frame(self, frame_class):
         frame = self.frames[frame_class]
         if hasattr(frame, "on_show"):
@@ -197,6 +2904,45 @@ class App(ctk.CTk, tk.Tk):
         frame.tkraise()
     def set_user(self, username: str | None):
         self.current_user = username
+    def get_model(self):
+        # Thread-safe: called from the warm-up thread and the AI worker
+        with self._model_lock:
+            if self._model is None:
+                self._model = self._create_model()
+            return self._model
+    def _warm_model(self):
+        try:
+            self.get_model()
+        except Exception:
+            pass  # reported when the genre flow actually needs the model
+    def _create_model(self):
+        if self.settings["ai_backend"] == "fake":
+            return FakeGenerativeModel(self.settings["ai_fake_latency"])
+        import google.generativeai as genai
+        api_key = os.getenv("GOOGLE_API_KEY")
+        if not api_key and os.path.exists("api_key.txt"):
+            api_key = self.load_api_key("api_key.txt")
+        if not api_key:
+            raise RuntimeError("GOOGLE_API_KEY not set in environment.")
+        genai.configure(api_key=api_key)
+
+        generation_config = {
+            "temperature": 0.5,
+            "top_p": 1,
+            "top_k": 1,
+            "max_output_tokens": 512,
+        }
+        safety_settings = [
+            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+        ]
+        return genai.GenerativeModel(
+            model_name=GEMINI_MODEL,
+            generation_config=generation_config,
+            safety_settings=safety_settings
+        )
     def load_api_key(self, path: str) -> str:
         with open(path, "r", encoding="utf-8") as f:
             return f.read().strip()
@@ -218,12 +2964,12 @@ class LoginFrame(tk.Frame):
         self.pass_entry.pack(padx=12, fill="x")
         btn_row = ctk.CTkFrame(self, fg_color="transparent")
         btn_row.pack(pady=16)
-        login_btn = ctk.CTkButton(
+        self.login_btn = ctk.CTkButton(
             btn_row, text="Login",
             fg_color=controller.accent_color, hover_color=controller.accent_hover,
             command=self.do_login
         )
-        login_btn.grid(row=0, column=0, padx=6)
+        self.login_btn.grid(row=0, column=0, padx=6)
         signup_btn = ctk.CTkButton(
             btn_row, text="Go to Signup",
             fg_color=controller.accent_color, hover_color=controller.accent_hover,
@@ -236,7 +2982,17 @@ class LoginFrame(tk.Frame):
         if not username or not password:
             messagebox.showwarning("Input required", "Please enter username and password.")
             return
-        if verify_user(username, password):
+        # bcrypt takes a while; a second click while it runs is ignored
+        task = self.controller.auth_worker.submit(
+            "login", verify_user, username, password, self.controller.bcrypt_rounds,
+            on_done=lambda ok: self._login_done(username, ok),
+            on_error=lambda e: self._login_done(username, False),
+        )
+        if task is not None:
+            self.login_btn.configure(state="disabled")
+    def _login_done(self, username, ok):
+        self.login_btn.configure(state="normal")
+        if ok:
             self.controller.set_user(username)
             self.controller.show_frame(LibraryFrame)
         else:
@@ -259,12 +3015,12 @@ class SignupFrame(tk.Frame):
         self.pass_entry.pack(padx=12, fill="x")
         btn_row = ctk.CTkFrame(self, fg_color="transparent")
         btn_row.pack(pady=16)
-        signup_btn = ctk.CTkButton(
+        self.signup_btn = ctk.CTkButton(
             btn_row, text="Create Account",
             fg_color=controller.accent_color, hover_color=controller.accent_hover,
             command=self.do_signup
         )
-        signup_btn.grid(row=0, column=0, padx=6)
+        self.signup_btn.grid(row=0, column=0, padx=6)
         back_btn = ctk.CTkButton(
             btn_row, text="Back to Login",
             fg_color=controller.accent_color, hover_color=controller.accent_hover,
@@ -277,7 +3033,15 @@ class SignupFrame(tk.Frame):
         if not username or not password:
             messagebox.showwarning("Input required", "Please enter username and password.")
             return
-        ok, msg = add_user(username, password)
+        task = self.controller.auth_worker.submit(
+            "signup", add_user, username, password, self.controller.bcrypt_rounds,
+            on_done=lambda result: self._signup_done(*result),
+            on_error=lambda e: self._signup_done(False, f"Signup failed: {e}"),
+        )
+        if task is not None:
+            self.signup_btn.configure(state="disabled")
+    def _signup_done(self, ok, msg):
+        self.signup_btn.configure(state="normal")
         if ok:
             messagebox.showinfo("Success", msg)
             self.controller.show_frame(LoginFrame)
@@ -293,6 +3057,11 @@ class LibraryFrame(tk.Frame):
     def on_show(self):
         # Refresh table on show
         self.library_view.refresh_tree()
+        self.library_view.watch_overdue()
+        self.library_view.watch_catalog()
+        # Lazily loaded and duplicate indexes are built off the Tk thread
+        # before the first search or duplicate check needs them
+        self.controller.search_worker.submit("prepare", self.controller.library.prepare)
 class LibraryView(ctk.CTkFrame):
     def __init__(self, parent, controller: App):
         super().__init__(parent, fg_color=controller.fg_color, corner_radius=8)
@@ -312,12 +3081,26 @@ class LibraryView(ctk.CTkFrame):
             border_color=controller.accent_color
         )
         self.search_entry.pack(side="left", fill="x", expand=True, padx=(0, 8))
+        self.search_var.trace_add("write", self._on_search_typed)
+        self._search_job = None
+        self._search_task = None
+        self._preview_task = None
+        self._search_seq = 0
+        # (lowercase keyword, catalog_version, result ids) of the last query
+        self._last_search = None
         search_btn = ctk.CTkButton(
             top_row, text="Search",
             fg_color=controller.accent_color, hover_color=controller.accent_hover,
             command=self.search_books
         )
         search_btn.pack(side="left", padx=(0, 8))
+        # One row per title ("3 of 5 available") instead of one per copy
+        self.group_var = tk.BooleanVar(value=False)
+        group_chk = ctk.CTkCheckBox(
+            top_row, text="Group copies", variable=self.group_var,
+            text_color=controller.text_color, command=self.search_books
+        )
+        group_chk.pack(side="left", padx=(0, 8))
         logout_btn = ctk.CTkButton(
             top_row, text="Logout",
             fg_color=controller.accent_color, hover_color=controller.accent_hover,
@@ -327,13 +3110,20 @@ class LibraryView(ctk.CTkFrame):
         # Treeview
         tree_frame = ctk.CTkFrame(self, fg_color="transparent")
         tree_frame.pack(fill="both", expand=True, padx=10)
-        columns = ('Title', 'Author', 'Available', 'Borrowed By')
-        self.tree = ttk.Treeview(tree_frame, columns=columns, show='headings')
+        columns = ('Title', 'Author', 'Available', 'Borrowed By', 'Due')
+        self.tree = ttk.Treeview(tree_frame, columns=columns, show='headings', yscrollcommand=self._on_tree_yscroll)
         for col in columns:
             self.tree.heading(col, text=col)
             self.tree.column(col, width=160, anchor="w")
         self.tree.column('Title', width=260)
+        self.tree.column('Due', width=120)
+        self.scrollbar = ttk.Scrollbar(tree_frame, orient="vertical", command=self._on_scroll)
+        self.scrollbar.pack(side="right", fill="y")
         self.tree.pack(fill="both", expand=True)
+        self.tree.bind("<<TreeviewSelect>>", self._on_select)
+        self.tree.bind("<Configure>", lambda e: self._virtual and self._render_window())
+        for seq in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.tree.bind(seq, self._on_wheel)
         # Buttons row
         btn_row = ctk.CTkFrame(self, fg_color="transparent")
         btn_row.pack(pady=10)
@@ -361,9 +3151,33 @@ class LibraryView(ctk.CTkFrame):
             command=self.find_books_frame
         )
         self.genre_btn.grid(row=0, column=3, padx=6, pady=4)
+        self.overdue_btn = ctk.CTkButton(
+            btn_row, text="Overdue (0)",
+            fg_color=controller.accent_color, hover_color=controller.accent_hover,
+            command=self.show_overdue
+        )
+        self.overdue_btn.grid(row=0, column=4, padx=6, pady=4)
+        self.report_btn = ctk.CTkButton(
+            btn_row, text="Reports",
+            fg_color=controller.accent_color, hover_color=controller.accent_hover,
+            command=self.show_reports
+        )
+        self.report_btn.grid(row=0, column=5, padx=6, pady=4)
+        self._overdue_job = None
+        self._sync_job = None
+        # Treeview rows are keyed by book_id ("title:<title>\n<author>" when grouped); remember what each row shows
+        self._row_values = {}
+        self._refresh_job = None
+        # Virtual mode: only rows shown[offset:offset + viewport] exist in the tree
+        self._virtual = False
+        self._shown = []
+        self._offset = 0
+        self._selected_id = None
         # Frames for genre flow
         self.genre_frame = None
         self.results_frame = None
+    ROW_HEIGHT = 26
+    VIRTUAL_BUFFER = 5
     def _style_ttk(self):
         style = ttk.Style()
         try:
@@ -378,7 +3192,7 @@ class LibraryView(ctk.CTkFrame):
             background=bg,
             fieldbackground=bg,
             foreground=txt,
-            rowheight=26,
+            rowheight=self.ROW_HEIGHT,
             bordercolor=bg,
             borderwidth=0)
         style.configure("Treeview.Heading",
@@ -396,15 +3210,147 @@ class LibraryView(ctk.CTkFrame):
         style.map("TCombobox",
             fieldbackground=[("readonly", fg)],
             foreground=[("readonly", txt)])
+    REFRESH_BUDGET = 0.03  # seconds of Tk work per main-loop turn
+    @metrics.timer("ui.refresh_tree")
     def refresh_tree(self, books=None):
-        self.tree.delete(*self.tree.get_children())
-        books = books or self.controller.library.books
-        for book in books:
-            self.tree.insert('', tk.END, values=(
-                book.title, book.author,
-                "Yes" if book.available else "No",
-                book.borrowed_by or ""
-            ))
+        # Diff the wanted rows against the tree: update rows whose values
+        # changed, insert new ones, detach filtered-out ones. Large updates
+        # are spread over several after() callbacks.
+        if self._refresh_job is not None:
+            self.after_cancel(self._refresh_job)
+            self._refresh_job = None
+        library = self.controller.library
+        if books is None:
+            books = library.title_records() if self.group_var.get() else library.books
+        if books is not self._shown:
+            self._offset = 0
+            self._selected_id = None
+        self._shown = books
+        if len(books) > self.controller.settings["virtual_table_threshold"]:
+            if not self._virtual:
+                self._virtual = True
+                self.tree.delete(*self._row_values)
+                self._row_values.clear()
+            self._render_window()
+            return
+        self._virtual = False
+        self._run_refresh(self._refresh_steps(books))
+    # -------- Virtual table ----------
+    def _viewport_rows(self):
+        height = self.tree.winfo_height()
+        return max(1, height // self.ROW_HEIGHT - 1) if height > 1 else 25
+    def _render_window(self):
+        total = len(self._shown)
+        rows = self._viewport_rows()
+        self._offset = max(0, min(self._offset, total - rows))
+        window = self._shown[self._offset:self._offset + rows + self.VIRTUAL_BUFFER]
+        for _ in self._refresh_steps(window, drop_hidden=True):
+            pass
+        self.tree.yview_moveto(0)
+        iid = self._selected_id
+        if iid in self._row_values and iid not in self.tree.selection():
+            self.tree.selection_set(iid)
+            self.tree.focus(iid)
+        if total:
+            self.scrollbar.set(self._offset / total, min(1.0, (self._offset + rows) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+    def _scroll_to(self, offset):
+        self._offset = int(offset)
+        self._render_window()
+    def _on_scroll(self, *args):
+        if not self._virtual:
+            self.tree.yview(*args)
+            return
+        rows = self._viewport_rows()
+        if args[0] == "moveto":
+            self._scroll_to(float(args[1]) * len(self._shown))
+        elif args[0] == "scroll":
+            step = rows if args[2] == "pages" else 1
+            self._scroll_to(self._offset + int(args[1]) * step)
+    def _on_tree_yscroll(self, first, last):
+        if not self._virtual:
+            self.scrollbar.set(first, last)
+    def _on_wheel(self, event):
+        if not self._virtual:
+            return None
+        if event.num == 4 or event.delta > 0:
+            self._scroll_to(self._offset - 3)
+        else:
+            self._scroll_to(self._offset + 3)
+        return "break"
+    def _on_select(self, event=None):
+        selection = self.tree.selection()
+        if selection:
+            self._selected_id = selection[0]
+    def _selected_book(self):
+        # A Book for copy rows, a TitleRecord for grouped rows
+        selected = self.tree.focus()
+        if not selected and self._virtual:
+            selected = self._selected_id
+        if not selected:
+            return None
+        library = self.controller.library
+        if selected.startswith("title:"):
+            title, author = selected[len("title:"):].rsplit("\n", 1)
+            return library.title_record(title, author)
+        return library.books[int(selected)]
+    @metrics.timer("ui.refresh_slice")
+    def _run_refresh(self, steps):
+        self._refresh_job = None
+        deadline = time.perf_counter() + self.REFRESH_BUDGET
+        for _ in steps:
+            if time.perf_counter() > deadline:
+                self._refresh_job = self.after(1, self._run_refresh, steps)
+                return
+    def _values_for(self, book):
+        library = self.controller.library
+        if isinstance(book, TitleRecord):
+            copies = [library.books[i] for i in book.copies]
+            borrowers = sorted({copy.borrowed_by for copy in copies} - {None})
+            shown = ", ".join(borrowers[:3]) + (f" +{len(borrowers) - 3}" if len(borrowers) > 3 else "")
+            due = min((copy.due_at for copy in copies if copy.due_at is not None), default=None)
+            overdue = any(i in library.loans.overdue for i in book.copies)
+            return (book.title, book.author, f"{len(book.available)} of {len(book.copies)}", shown,
+                    self._due_text(due, overdue))
+        due = self._due_text(book.due_at, book.book_id in library.loans.overdue)
+        return (book.title, book.author, "Yes" if book.available else "No", book.borrowed_by or "", due)
+    @staticmethod
+    def _due_text(due_at, overdue):
+        if due_at is None:
+            return ""
+        return time.strftime("%Y-%m-%d", time.localtime(due_at)) + (" (overdue)" if overdue else "")
+    @staticmethod
+    def _row_id(item):
+        return item.row_id if isinstance(item, TitleRecord) else str(item.book_id)
+    def _refresh_steps(self, books, drop_hidden=False):
+        tree = self.tree
+        wanted = [self._row_id(book) for book in books]
+        wanted_set = set(wanted)
+        shown = tree.get_children()
+        hidden = [iid for iid in shown if iid not in wanted_set]
+        if hidden and drop_hidden:
+            tree.delete(*hidden)
+            for iid in hidden:
+                del self._row_values[iid]
+        elif hidden:
+            tree.detach(*hidden)
+        attached = [iid for iid in shown if iid in wanted_set]
+        # Rows already in the right order stay put; only the rest are moved
+        in_order = attached == wanted[:len(attached)]
+        if not in_order:
+            tree.detach(*attached)
+        done = len(attached) if in_order else 0
+        for index, (iid, book) in enumerate(zip(wanted, books)):
+            values = self._values_for(book)
+            if iid not in self._row_values:
+                tree.insert('', index, iid=iid, values=values)
+            elif self._row_values[iid] != values:
+                tree.item(iid, values=values)
+            if index >= done and iid in self._row_values:
+                tree.move(iid, '', index)
+            self._row_values[iid] = values
+            yield
     def add_book_popup(self):
         win = ctk.CTkToplevel(self)
         win.title("Add Book")
@@ -425,6 +3371,9 @@ class LibraryView(ctk.CTkFrame):
             if not t or not a:
                 messagebox.showwarning("Input required", "Please provide both title and author.")
                 return
+            if self.controller.library.is_duplicate(t, a) and not messagebox.askyesno(
+                    "Already in catalog", f"'{t}' by {a} is already in the catalog. Add another copy?", parent=win):
+                return
             self.controller.library.add_book(Book(t, a), actor=self.controller.current_user or "unknown")
             self.refresh_tree()
             win.destroy()
@@ -466,35 +3415,182 @@ class LibraryView(ctk.CTkFrame):
         )
         go_btn.pack(pady=14)
     def checkout_selected(self, user_id, win):
-        selected = self.tree.focus()
-        if not selected:
+        book = self._selected_book()
+        if book is None:
             messagebox.showinfo("Status", "Please select a book.")
             return
         if not user_id:
             messagebox.showinfo("Status", "Please enter a borrower ID.")
             return
-        title = self.tree.item(selected)['values'][0]
-        success = self.controller.library.checkout_book(title, user_id, actor=self.controller.current_user or "unknown")
+        library = self.controller.library
+        actor = self.controller.current_user or "unknown"
+        if isinstance(book, TitleRecord):
+            success = library.checkout_book(book.title, user_id, actor=actor, author=book.author)
+        else:
+            success = library.checkout_copy(book.book_id, user_id, actor=actor)
         messagebox.showinfo("Status", "Checked out!" if success else "Failed.")
         self.refresh_tree()
+        self.watch_overdue()
         win.destroy()
     def return_selected(self, user_id, win):
-        selected = self.tree.focus()
-        if not selected:
+        book = self._selected_book()
+        if book is None:
             messagebox.showinfo("Status", "Please select a book.")
             return
         if not user_id:
             messagebox.showinfo("Status", "Please enter a borrower ID.")
             return
-        title = self.tree.item(selected)['values'][0]
-        success = self.controller.library.return_book(title, user_id, actor=self.controller.current_user or "unknown")
+        library = self.controller.library
+        actor = self.controller.current_user or "unknown"
+        if isinstance(book, TitleRecord):
+            success = library.return_book(book.title, user_id, actor=actor, author=book.author)
+        else:
+            success = library.return_copy(book.book_id, user_id, actor=actor)
         messagebox.showinfo("Status", "Returned!" if success else "Failed.")
         self.refresh_tree()
+        self.watch_overdue()
         win.destroy()
+    # -------- Overdue loans ----------
+    OVERDUE_RECHECK = 60_000  # ms; wake at least this often in case the wall clock jumps
+    def watch_overdue(self):
+        # One after() timer, armed for the earliest due date in the heap
+        if self._overdue_job is not None:
+            self.after_cancel(self._overdue_job)
+            self._overdue_job = None
+        library = self.controller.library
+        self.overdue_btn.configure(text=f"Overdue ({len(library.loans.overdue)})")
+        upcoming = library.next_due()
+        if upcoming is None:
+            return
+        delay = max(0, int((upcoming[0] - library.clock()) * 1000)) + 1
+        self._overdue_job = self.after(min(delay, self.OVERDUE_RECHECK), self._on_overdue_timer)
+    def _on_overdue_timer(self):
+        self._overdue_job = None
+        fired = self.controller.library.pop_overdue()
+        if fired:
+            # Re-render only if one of the newly overdue loans is on screen
+            if any(str(book.book_id) in self._row_values or TitleRecord.row_key(book.title, book.author) in self._row_values for book in fired):
+                self.refresh_tree(self._shown)
+        self.watch_overdue()
+    def show_overdue(self):
+        overdue = self.controller.library.overdue_loans()
+        self.watch_overdue()
+        if not overdue:
+            messagebox.showinfo("Overdue", "No loans are overdue.")
+            return
+        self.refresh_tree(overdue)
+    # -------- Other instances ----------
+    def watch_catalog(self):
+        # Shared storage: poll for changes made by other instances
+        if self._sync_job is not None:
+            self.after_cancel(self._sync_job)
+            self._sync_job = None
+        if self.controller.library.shared:
+            self._sync_job = self.after(int(self.controller.settings["sync_interval"] * 1000), self._on_sync_timer)
+    def _on_sync_timer(self):
+        self._sync_job = None
+        try:
+            if self.controller.library.sync():
+                self.search_books()
+                self.watch_overdue()
+        except Exception as e:
+            # Locked out or a record this version cannot read: try again
+            # at the next poll rather than stop polling
+            write_log(f"Could not pick up catalog changes: {e!r}")
+        finally:
+            self.watch_catalog()
+    # -------- Reports ----------
+    def show_reports(self):
+        win = ctk.CTkToplevel(self)
+        win.title("Reports")
+        win.geometry("460x420")
+        win.configure(fg_color=self.controller.fg_color)
+        text = ctk.CTkTextbox(win, fg_color=self.controller.entry_bg, text_color=self.controller.text_color)
+        text.pack(fill="both", expand=True, padx=12, pady=12)
+        text.insert("end", "Reading log...")
+        text.configure(state="disabled")
+        analytics = self.controller.analytics
+        def update():
+            log_sink.flush()
+            analytics.update()
+            return analytics.report()
+        def show(report):
+            if not win.winfo_exists():
+                return
+            text.configure(state="normal")
+            text.delete("1.0", "end")
+            text.insert("end", report)
+            text.configure(state="disabled")
+        def failed(error):
+            if win.winfo_exists():
+                show(f"Could not read the log: {error}")
+        self.controller.report_worker.submit("report", update, on_done=show, on_error=failed)
+    # -------- Live search ----------
+    SEARCH_DEBOUNCE = 150  # ms without typing before a query starts
+    def _on_search_typed(self, *args):
+        if self._search_job is not None:
+            self.after_cancel(self._search_job)
+        self._search_job = self.after(self.SEARCH_DEBOUNCE, self.search_books)
+    SEARCH_PREVIEW = 200  # rows shown while a large catalog is searched
+    SEARCH_PREVIEW_FROM = 20000  # books before a preview is worth a task
     def search_books(self):
+        # Runs filter_books on the search worker through library.query, so
+        # the Tk thread never waits for it and edits made meanwhile only
+        # cost a retry; a newer query cancels the one in flight, so stale
+        # results never reach the table. Large catalogs first get the first
+        # SEARCH_PREVIEW matches. A keyword extending the previous one only
+        # re-checks the previous hits.
+        if self._search_job is not None:
+            self.after_cancel(self._search_job)
+            self._search_job = None
+        for task in (self._preview_task, self._search_task):
+            if task is not None:
+                task.cancel()
+        self._preview_task = self._search_task = None
         keyword = self.search_var.get().strip()
-        filtered = self.controller.library.filter_books(keyword) if keyword else self.controller.library.books
-        self.refresh_tree(filtered)
+        library = self.controller.library
+        grouped = self.group_var.get()
+        if not keyword:
+            self._last_search = None
+            self.refresh_tree()
+            return
+        last = self._last_search
+        version = library.catalog_version
+        within = last[2] if last and last[1] == version and last[0] in keyword.lower() else None
+        worker = self.controller.search_worker
+        self._search_seq += 1
+        def rows(books):
+            return library.title_records(books) if grouped else books
+        def preview():
+            return library.query(lambda: rows(library.first_matches(keyword, self.SEARCH_PREVIEW)))
+        def shown(result):
+            self._preview_task = None
+            if self._search_task is not None:
+                self.refresh_tree(result[0])
+        def query():
+            # The previous hits only narrow the search while the catalog
+            # is still the one they were found in
+            narrowed = within if library.catalog_version == version else None
+            books = library.filter_books(keyword, within=narrowed)
+            return [book.book_id for book in books], rows(books)
+        def done(result):
+            self._search_task = None
+            (ids, found), found_at = result
+            self._last_search = (keyword.lower(), found_at, ids)
+            self.refresh_tree(found)
+        def preview_failed(error):
+            self._preview_task = None
+        def failed(error):
+            self._search_task = None
+            self._last_search = None
+            write_log(f"Search for '{keyword}' failed: {error}")
+        if within is None and len(library.books) >= self.SEARCH_PREVIEW_FROM:
+            self._preview_task = worker.submit(
+                ("preview", self._search_seq), preview, on_done=shown, on_error=preview_failed
+            )
+        self._search_task = worker.submit(
+            ("search", self._search_seq), library.query, query, on_done=done, on_error=failed
+        )
     def logout(self):
         write_log(f"Logout by '{self.controller.current_user or 'unknown'}'")
         self.controller.set_user(None)
@@ -521,69 +3617,77 @@ class LibraryView(ctk.CTkFrame):
         combo_frame.pack(pady=(0, 10))
         genre_menu = ttk.Combobox(combo_frame, values=genres, textvariable=self.genre_var, state="readonly", width=28)
         genre_menu.pack()
+        gf.status = ctk.CTkLabel(gf, text="", text_color=self.controller.text_color)
+        gf.status.pack()
+        gf.progress = ctk.CTkProgressBar(gf, mode="indeterminate")
+        gf.task = None
         btn_row = ctk.CTkFrame(gf, fg_color="transparent")
         btn_row.pack(pady=10)
-        search_btn = ctk.CTkButton(
+        gf.search_btn = ctk.CTkButton(
             btn_row, text="Search",
             fg_color=self.controller.accent_color, hover_color=self.controller.accent_hover,
             command=lambda: self._find_books(gf)
         )
-        search_btn.grid(row=0, column=0, padx=6)
+        gf.search_btn.grid(row=0, column=0, padx=6)
         close_btn = ctk.CTkButton(
             btn_row, text="Close",
             fg_color=self.controller.accent_color, hover_color=self.controller.accent_hover,
-            command=gf.destroy
+            command=lambda: self._close_genre_frame(gf)
         )
         close_btn.grid(row=0, column=1, padx=6)
+        gf.protocol("WM_DELETE_WINDOW", lambda: self._close_genre_frame(gf))
+    def _close_genre_frame(self, gf):
+        # Closing the window abandons any request still in flight
+        if gf.task is not None:
+            gf.task.cancel()
+        gf.destroy()
+    def _set_genre_busy(self, gf, busy, text=""):
+        gf.status.configure(text=text)
+        if busy:
+            gf.progress.pack(fill="x", padx=40, pady=(4, 0))
+            gf.progress.start()
+            gf.search_btn.configure(state="disabled")
+        else:
+            gf.progress.stop()
+            gf.progress.pack_forget()
+            gf.search_btn.configure(state="normal")
     def _find_books(self, parent_win):
         genre = self.genre_var.get()
-        try:
-            prompt = f"""
-    You are a helpful assistant that recommends books for a library system.
-    Given a genre, return a JSON object with an array of books, each with 'title' and 'author'.
-    Do not include any extra commentary or explanation, only valid JSON.
-    Genre: {genre}
-    Return format:
-    {{
-    "books": [
-        {{"title": "Title 1", "author": "Author 1"}},
-        {{"title": "Title 2", "author": "Author 2"}}
-    ]
-    }}
-    """
-
-            # Use the model from the App (controller)
-            response = self.controller.model.generate_content(prompt)  # ← key change
-            raw_text = (response.text or "").strip()                   # ← no output_text, no resolve()
-            print(response)
-            # Parse JSON (with a small salvage if the model adds text around it)
-            try:
-                data = json.loads(raw_text)
-            except json.JSONDecodeError:
-                start, end = raw_text.find("{"), raw_text.rfind("}")
-                if start != -1 and end != -1 and end > start:
-                    data = json.loads(raw_text[start:end+1])
-                else:
-                    raise
-
-            books_json = data.get("books", [])
-            existing_titles = {b.title for b in self.controller.library.books}
-            book_list = []
-            for item in books_json:
-                title = (item.get("title") or "").strip()
-                author = (item.get("author") or "").strip()
-                if title and author and title not in existing_titles:
-                    book_list.append((title, author))
-
-            if not book_list:
-                messagebox.showinfo("No books", "No new books found for this genre.")
-                return
-
-            parent_win.destroy()
-            self._show_genre_results(book_list)
-
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to fetch books via AI: {e}")
+        cache = self.controller.ai_cache
+        key = cache.key(genre, self.controller.model_name)
+        cached = cache.get(key)
+        if cached is not None:
+            self._on_recommendations(parent_win, cached)
+            return
+        def fetched(books):
+            cache.put(key, books)
+            self._on_recommendations(parent_win, books)
+        controller = self.controller
+        task = controller.ai_worker.submit(
+            ("genre", genre), lambda: fetch_recommendations(controller.get_model(), genre),
+            on_done=fetched,
+            on_error=lambda e: self._on_recommendations_failed(parent_win, e),
+            timeout=self.controller.settings["ai_timeout"],
+        )
+        if task is None:
+            messagebox.showinfo("Please wait", f"Already looking up {genre} books.")
+            return
+        parent_win.task = task
+        self._set_genre_busy(parent_win, True, f"Asking for {genre} books...")
+    def _on_recommendations(self, parent_win, books):
+        parent_win.task = None
+        self._set_genre_busy(parent_win, False)
+        library = self.controller.library
+        book_list = [(title, author) for title, author in books if not library.is_duplicate(title, author)]
+        if not book_list:
+            messagebox.showinfo("No books", "No new books found for this genre.")
+            return
+        parent_win.destroy()
+        self._show_genre_results(book_list)
+    def _on_recommendations_failed(self, parent_win, error):
+        parent_win.task = None
+        self._set_genre_busy(parent_win, False)
+        messagebox.showerror("Error", f"Failed to fetch books via AI: {error}")
 
     def _show_genre_results(self, book_list):
         rf = ctk.CTkToplevel(self)  # rf declared here
@@ -608,9 +3712,8 @@ class LibraryView(ctk.CTkFrame):
         btn_row.pack(pady=10)
         def add_selected():
             actor = self.controller.current_user or "unknown"
-            for cb in checks:
-                if cb.var.get():
-                    self.controller.library.add_book(Book(cb.title, cb.author), actor=actor)
+            selected = [Book(cb.title, cb.author) for cb in checks if cb.var.get()]
+            self.controller.library.add_books(selected, actor=actor, skip_duplicates=True)
             self.refresh_tree()
             rf.destroy()
         add_btn = ctk.CTkButton(
@@ -627,5 +3730,13 @@ class LibraryView(ctk.CTkFrame):
         cancel_btn.grid(row=0, column=1, padx=6)
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
     app = App()
-    app.mainloop()
\ No newline at end of file
+    app.mainloop()
+    if app.watchdog:
+        app.watchdog.stop()
+    app.library.storage.close()
+    app.ai_cache.flush()
+    metrics.flush()
+    log_sink.flush()
\ No newline at end of file
@@ -0,0 +1,113 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+import subprocess
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from catalyst import LogSink
+
+
+def read_lines(path):
+    with open(path, "r", encoding="utf-8") as f:
+        # Drop the "[timestamp] " prefix
+        return [line.rstrip("\n").split("] ", 1)[1] for line in f]
+
+
+class LogSinkTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "log.txt")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_order_across_batches_and_threads(self):
+        # Small batches so the writer flushes many times while threads write
+        sink = LogSink(self.path, max_bytes=0, flush_lines=7, flush_interval=0.001)
+        def writer(name):
+            for i in range(300):
+                if i % 3 == 0:
+                    sink.write([f"{name} {i} a", f"{name} {i} b"])
+                else:
+                    sink.write([f"{name} {i}"])
+        threads = [threading.Thread(target=writer, args=(f"t{k}",)) for k in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(sink.flush())
+        lines = read_lines(self.path)
+        self.assertEqual(len(lines), 4 * 400)
+        for k in range(4):
+            mine = [line for line in lines if line.startswith(f"t{k} ")]
+            expected = []
+            for i in range(300):
+                expected += [f"t{k} {i} a", f"t{k} {i} b"] if i % 3 == 0 else [f"t{k} {i}"]
+            self.assertEqual(mine, expected)
+        # One write() call stays together even with other threads writing
+        for n, line in enumerate(lines):
+            if line.endswith(" a"):
+                self.assertEqual(lines[n + 1], line[:-1] + "b")
+
+    def test_flush_waits_for_everything_queued_before_it(self):
+        sink = LogSink(self.path, max_bytes=0, flush_lines=10 ** 6, flush_interval=60)
+        sink.write([f"line {i}" for i in range(1000)])
+        sink.write(["last"])
+        self.assertTrue(sink.flush())
+        lines = read_lines(self.path)
+        self.assertEqual(lines, [f"line {i}" for i in range(1000)] + ["last"])
+
+    def test_exit_writes_every_queued_line(self):
+        # The module-level sink is flushed by atexit; nothing else forces it
+        script = (
+            "import sys; sys.path.insert(0, sys.argv[1])\n"
+            "import catalyst\n"
+            "catalyst.log_sink.path = sys.argv[2]\n"
+            "catalyst.log_sink.flush_lines = 10 ** 6\n"
+            "catalyst.log_sink.flush_interval = 60\n"
+            "for i in range(2000):\n"
+            "    catalyst.write_log(f'line {i}')\n"
+        )
+        subprocess.run([sys.executable, "-c", script, ROOT, self.path], cwd=self.tmp.name, check=True, timeout=60)
+        self.assertEqual(read_lines(self.path), [f"line {i}" for i in range(2000)])
+
+    def test_rotation_at_max_bytes(self):
+        sink = LogSink(self.path, max_bytes=300, backups=2, flush_lines=1, flush_interval=0)
+        for i in range(100):
+            sink.write([f"line {i:03d}"])
+            self.assertTrue(sink.flush())
+        self.assertTrue(os.path.exists(self.path + ".1"))
+        self.assertTrue(os.path.exists(self.path + ".2"))
+        self.assertFalse(os.path.exists(self.path + ".3"))
+        # Rotation happens before an append once the file reached max_bytes
+        for path in (self.path, self.path + ".1", self.path + ".2"):
+            self.assertLess(os.path.getsize(path), 300 + 40)
+        kept = read_lines(self.path + ".2") + read_lines(self.path + ".1") + read_lines(self.path)
+        self.assertEqual(kept, [f"line {i:03d}" for i in range(100 - len(kept), 100)])
+
+    def test_unencodable_text_does_not_stop_the_writer(self):
+        sink = LogSink(self.path, max_bytes=0, flush_lines=1, flush_interval=0)
+        sink.write(["User 'bad\ud800name' logged in"])
+        sink.write(["after"])
+        self.assertTrue(sink.flush(timeout=5))
+        lines = read_lines(self.path)
+        self.assertEqual(lines[-1], "after")
+        self.assertIn("\\ud800", lines[0])
+
+    def test_flush_gives_up_after_timeout(self):
+        sink = LogSink(self.path, max_bytes=0, flush_lines=1, flush_interval=0)
+        release = threading.Event()
+        sink._append = lambda text: release.wait(10)
+        sink.write(["stuck"])
+        start = time.monotonic()
+        self.assertFalse(sink.flush(timeout=0.2))
+        self.assertLess(time.monotonic() - start, 5)
+        release.set()
+
+
+if __name__ == "__main__":
+    unittest.main()